@@ -0,0 +1,4 @@
+"""Offline benchmarks for the scrapers. Run from the repository root, e.g.:
+
+    python -m benchmarks.parsers
+"""
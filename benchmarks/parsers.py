@@ -0,0 +1,60 @@
+"""Compares the per-page parse time of each installed HTML parser backend on
+saved Reports and Decisions pages, with and without partial parsing.
+
+    python -m benchmarks.parsers [--repeat N] [page.html ...]
+
+With no arguments, uses the pages in benchmarks/fixtures/somervillema.
+"""
+import argparse
+import glob
+import os
+import statistics
+import time
+
+import scrape_utils
+import somervillema
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def time_parser(parser, pages, repeat, parse_only=None):
+    """Returns a list of per-page timings (in seconds) for parsing each page and
+    extracting its cases.
+
+    """
+    timings = []
+    for _ in range(repeat):
+        for html in pages:
+            start = time.perf_counter()
+            doc = scrape_utils.make_soup(html, parser, parse_only=parse_only)
+            somervillema.find_cases(doc)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument("pages", nargs="*", default=sorted(glob.glob(
+        os.path.join(FIXTURES_DIR, "somervillema", "*.html"))))
+    argparser.add_argument("--repeat", type=int, default=5)
+    args = argparser.parse_args(argv)
+
+    pages = []
+    for path in args.pages:
+        with open(path, "rb") as infile:
+            pages.append(infile.read())
+
+    print(f"{len(pages)} pages, {args.repeat} repetitions")
+    print(f"{'parser':<12} {'mode':<8} {'mean ms':>9} {'min ms':>9} {'max ms':>9}")
+    for parser in scrape_utils.available_parsers():
+        for mode, strainer in [("full", None),
+                               ("partial", somervillema.PAGE_STRAINER)]:
+            timings = [t * 1000 for t in
+                       time_parser(parser, pages, args.repeat, strainer)]
+            print(f"{parser:<12} {mode:<8} {statistics.mean(timings):>9.2f} "
+                  f"{min(timings):>9.2f} {max(timings):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""A record/replay stand-in for the network.
+
+`ReplayAdapter` is a requests transport adapter that answers requests from
+files listed in an index (benchmarks/fixtures/replay.json by default), so that
+scrapers can run against checked-in fixtures without touching the live sites.
+URLs that are not in the index get an empty 404 response.
+
+To record new fixtures from the live sites:
+
+    python -m benchmarks.replay record DIRECTORY URL [URL ...]
+"""
+from contextlib import contextmanager
+import hashlib
+import io
+import json
+import os
+import sys
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+import http_cache
+import http_client
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+INDEX_NAME = "replay.json"
+
+
+def load_index(directory):
+    try:
+        with open(os.path.join(directory, INDEX_NAME)) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return {}
+
+
+def make_response(request, status, headers, content):
+    response = Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.raw = io.BytesIO(content)
+    response._content = content
+    response.url = request.url
+    response.request = request
+    response.reason = "OK" if status == 200 else "Not Found"
+    response.encoding = None
+    return response
+
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, directory=FIXTURES_DIR):
+        super().__init__()
+        self.directory = directory
+        self.index = load_index(directory)
+        self.requests = 0
+        self.misses = []
+
+    def send(self, request, **kwargs):
+        self.requests += 1
+        entry = self.index.get(request.url)
+        if not entry:
+            self.misses.append(request.url)
+            return make_response(request, 404, {}, b"")
+
+        with open(os.path.join(self.directory, entry["file"]), "rb") as infile:
+            content = infile.read()
+
+        return make_response(request, entry.get("status", 200),
+                             entry.get("headers", {}), content)
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    "Performs real requests, saving each response body and adding it to the index."
+    def __init__(self, directory, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.index = load_index(directory)
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        content = response.content
+        ext = os.path.splitext(request.path_url.split("?")[0])[1] or ".html"
+        name = "recorded/" + hashlib.sha1(request.url.encode()).hexdigest() + ext
+        os.makedirs(os.path.join(self.directory, "recorded"), exist_ok=True)
+        with open(os.path.join(self.directory, name), "wb") as outfile:
+            outfile.write(content)
+
+        self.index[request.url] = {
+            "file": name,
+            "status": response.status_code,
+            "headers": {"Content-Type": response.headers.get("Content-Type", "")}
+        }
+        with open(os.path.join(self.directory, INDEX_NAME), "w") as outfile:
+            json.dump(self.index, outfile, indent=2, sort_keys=True)
+
+        return response
+
+
+@contextmanager
+def mounted(adapter):
+    """Routes all requests made through the shared HTTP client to `adapter`,
+    bypassing the page cache.
+
+    """
+    session = http_client.session()
+    saved_adapters = dict(session.adapters)
+    saved_cache = http_cache._default_cache
+    http_cache._default_cache = http_cache.NullCache()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    try:
+        yield adapter
+    finally:
+        session.adapters.clear()
+        session.adapters.update(saved_adapters)
+        http_cache._default_cache = saved_cache
+
+
+def replaying(directory=FIXTURES_DIR):
+    return mounted(ReplayAdapter(directory))
+
+
+def recording(directory=FIXTURES_DIR):
+    return mounted(RecordingAdapter(directory))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "record":
+        print(__doc__)
+        sys.exit(1)
+
+    with recording(sys.argv[2]):
+        for url in sys.argv[3:]:
+            print(url, http_client.get(url).status_code)
@@ -0,0 +1,288 @@
+"""Runs each scraper's parse path against the checked-in fixtures, entirely
+offline, and reports throughput, latency and peak memory.
+
+    python -m benchmarks.run [--repeat N] [--only NAME] [--output FILE]
+                             [--compare FILE]
+
+Results are written as JSON (by default to benchmarks/results/<commit>.json)
+so that runs from different commits can be compared with --compare.
+"""
+import argparse
+from collections import namedtuple
+from datetime import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from dateutil.parser import parse as dt_parse
+
+os.environ.setdefault("SOCRATA_TOKEN", "")
+os.environ.setdefault("HTTP_CACHE_DISABLED", "1")
+
+import cambridgema
+from extractors import extract
+import greenline
+from scrape_utils import make_soup, scrape
+import somervillema
+import somervillema_events
+import stores
+from watermark import Watermark
+
+from benchmarks.replay import FIXTURES_DIR, replaying
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# - inputs: a function that returns a list of inputs
+# - run: a function that processes one input and returns the number of
+#   rows (cases, events, records, properties) it produced
+# - unit: what each input represents
+Scenario = namedtuple("Scenario", ["name", "inputs", "run", "unit"])
+
+
+def fixture_path(*parts):
+    return os.path.join(FIXTURES_DIR, *parts)
+
+
+def read_fixture(*parts):
+    with open(fixture_path(*parts), "rb") as infile:
+        return infile.read()
+
+
+def read_fixtures(pattern):
+    return [read_fixture(path) for path in
+            sorted(glob.glob(fixture_path(pattern)))]
+
+
+class FixtureDoc(object):
+    "Stands in for extractors.s3doc.S3Doc, using a text file and its metadata."
+    def __init__(self, text_path):
+        with open(text_path) as infile:
+            self.lines = infile.readlines()
+        with open(os.path.splitext(text_path)[0] + ".json") as infile:
+            self.metadata = json.load(infile)
+
+    @property
+    def line_iterator(self):
+        return iter(self.lines)
+
+    @property
+    def published(self):
+        created = self.metadata.get("doc_created")
+        return created and dt_parse(created)
+
+    @property
+    def title(self):
+        return self.metadata["document_title"]
+
+    @property
+    def tag_set(self):
+        return set(json.loads(self.metadata["tags"]))
+
+    @property
+    def region_name(self):
+        return self.metadata["region_name"]
+
+    @property
+    def field(self):
+        return self.metadata["field"]
+
+
+def counting(fn):
+    "For scenarios that produce one row per input."
+    return lambda item: 1 if fn(item) is not None else 0
+
+
+def parsed_fixtures(pattern):
+    return [make_soup(html) for html in read_fixtures(pattern)]
+
+
+def crawl_somervillema(_):
+    with replaying():
+        return len(list(somervillema.get_cases(
+            somervillema.get_pages(workers=1))))
+
+
+def incremental_somervillema(_):
+    """Scrapes with a watermark older than most of the fixture cases, checking
+    that it returns the same cases as a scrape since that date.
+
+    """
+    since = somervillema.TIMEZONE.localize(datetime(2020, 10, 20))
+    with replaying(), tempfile.TemporaryDirectory() as directory:
+        watermark = Watermark("somervillema", stores.FileStore(directory),
+                              since.timestamp())
+        cases = somervillema.get_proposals_since(watermark=watermark)
+        expected = somervillema.get_proposals_since(since)
+
+    if [c["case_number"] for c in cases] != \
+       [c["case_number"] for c in expected]:
+        raise AssertionError(f"A stale watermark returned {len(cases)} cases; "
+                             f"expected {len(expected)}")
+    return len(cases)
+
+
+SCENARIOS = [
+    Scenario("somervillema.find_cases",
+             lambda: read_fixtures("somervillema/*.html"),
+             lambda html: len(somervillema.find_cases(
+                 somervillema.parse_page(html))),
+             "pages"),
+    Scenario("somervillema.get_cases",
+             lambda: [None],
+             crawl_somervillema,
+             "crawls"),
+    Scenario("somervillema.incremental",
+             lambda: [None],
+             incremental_somervillema,
+             "crawls"),
+    Scenario("somervillema_events.get_events",
+             lambda: read_fixtures("somervillema_events/listing.html"),
+             lambda html: len(somervillema_events.get_events(make_soup(html))),
+             "pages"),
+    Scenario("somervillema_events.get_event_details",
+             lambda: read_fixtures("somervillema_events/event.html"),
+             counting(lambda html: somervillema_events.get_event_details(
+                 make_soup(html))),
+             "pages"),
+    # Interpreting the events DSL specs vs. running their compiled plans, on
+    # pre-parsed pages:
+    Scenario("scrape_utils.interpreted.events",
+             lambda: parsed_fixtures("somervillema_events/listing.html"),
+             lambda doc: len(scrape(doc, somervillema_events.events_spec())),
+             "pages"),
+    Scenario("scrape_utils.compiled.events",
+             lambda: parsed_fixtures("somervillema_events/listing.html"),
+             lambda doc: len(somervillema_events.get_events(doc)),
+             "pages"),
+    Scenario("scrape_utils.interpreted.event_details",
+             lambda: parsed_fixtures("somervillema_events/event.html"),
+             counting(lambda doc: scrape(
+                 doc, somervillema_events.EVENT_DETAILS_SPEC)),
+             "pages"),
+    Scenario("scrape_utils.compiled.event_details",
+             lambda: parsed_fixtures("somervillema_events/event.html"),
+             counting(somervillema_events.get_event_details),
+             "pages"),
+    Scenario("greenline.scrape_events",
+             lambda: read_fixtures("greenline/*.html"),
+             lambda html: len(greenline.scrape_events(make_soup(html))),
+             "pages"),
+    Scenario("cambridgema.process_json",
+             lambda: json.loads(read_fixture("cambridgema/urfm-usws.json")
+                                .decode("utf-8")),
+             counting(cambridgema.process_json),
+             "records"),
+    Scenario("extract.get_properties",
+             lambda: [FixtureDoc(path) for path in
+                      sorted(glob.glob(fixture_path("extract/*.txt")))],
+             lambda doc: len(extract.get_properties(doc)["attributes"]),
+             "docs"),
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_scenario(scenario, repeat):
+    inputs = scenario.inputs()
+    latencies = []
+    rows = 0
+
+    # Warm up, and measure peak memory separately, since tracing allocations
+    # slows everything down.
+    tracemalloc.start()
+    for item in inputs:
+        scenario.run(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in inputs:
+            t = time.perf_counter()
+            rows += scenario.run(item)
+            latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "unit": scenario.unit,
+        "inputs": len(inputs),
+        "repeat": repeat,
+        f"{scenario.unit}_per_sec": len(latencies) / elapsed,
+        "rows_per_sec": rows / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    print(f"{'scenario':<40} {'thru/s':>10} {'rows/s':>10} {'p50 ms':>9} "
+          f"{'p95 ms':>9} {'peak KB':>9}")
+    for name, result in results.items():
+        thru = result[result["unit"] + "_per_sec"]
+        print(f"{name:<40} {thru:>10.1f} {result['rows_per_sec']:>10.1f} "
+              f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+              f"{result['peak_memory_kb']:>9.0f}")
+        if baseline and name in baseline:
+            old = baseline[name]
+            changes = ", ".join(
+                f"{key} {(result[key] - old[key]) / old[key]:+.1%}"
+                for key in ["rows_per_sec", "p50_ms", "p95_ms", "peak_memory_kb"]
+                if old.get(key))
+            print(f"{'':<40} vs. baseline: {changes}")
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument("--repeat", type=int, default=20)
+    argparser.add_argument("--only", action="append",
+                           help="Run only the scenarios whose names contain this")
+    argparser.add_argument("--output")
+    argparser.add_argument("--compare",
+                           help="A results file to compare against")
+    args = argparser.parse_args(argv)
+
+    results = {}
+    for scenario in SCENARIOS:
+        if args.only and not any(s in scenario.name for s in args.only):
+            continue
+        results[scenario.name] = run_scenario(scenario, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)["results"]
+    print_results(results, baseline)
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as outfile:
+        json.dump({"commit": commit,
+                   "python": platform.python_version(),
+                   "timestamp": time.time(),
+                   "results": results}, outfile, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
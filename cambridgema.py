@@ -3,9 +3,9 @@ import os
 import re
 
 import pytz
-from dateutil.parser import parse as date_parse
 
 from cloud import aws_lambda
+from dates import DateParser
 from shared import preprocess
 import socrata
 
@@ -25,6 +25,7 @@ remap_attributes = {
 SOCRATA_TOKEN = os.environ["SOCRATA_TOKEN"]
 TIMEZONE = pytz.timezone("US/Eastern")
 REGION_NAME = "Cambridge, MA"
+SOCRATA_DATES = DateParser()
 
 def under_to_title(s):
     return " ".join(word.capitalize() for word in re.split(r"_+", s))
@@ -53,7 +54,7 @@ def process_json(pjson):
 
     updated_datestr = pjson.get("decisiondate",
                                 pjson["applicationdate"])
-    updated_naive = date_parse(updated_datestr)
+    updated_naive = SOCRATA_DATES.parse(updated_datestr)
     proposal["updated_date"] = TIMEZONE.localize(updated_naive)
     proposal["complete"] = match_complete(pjson["status"])
     proposal["description"] = pjson.get("reason_for_petition_other", "")
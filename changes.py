@@ -0,0 +1,105 @@
+"""Change detection for scraped cases.
+
+Each case is summarized by a fingerprint: a hash of its normalized contents.
+A `Snapshot` remembers the fingerprints produced by the last run for a
+region, so that later runs can report only the cases that are new or have
+changed, along with tombstones for cases that have disappeared.
+
+Snapshots are kept in the store configured by SNAPSHOT_DIR or SNAPSHOT_BUCKET
+(see `stores.store_from_env`).
+"""
+import hashlib
+import json
+import time
+
+from cloud import json_serialize
+from stores import RegionState
+
+
+# Forget cases that have not been seen by a scan in this many seconds:
+SNAPSHOT_MAX_AGE = 365*24*60*60
+
+
+def fingerprint(case):
+    """Returns a stable hash of the case's contents, including its documents and
+    events.
+
+    """
+    normalized = {k: v for k, v in case.items() if k != "fingerprint"}
+    serialized = json.dumps(normalized, sort_keys=True, default=json_serialize)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+class Snapshot(RegionState):
+    STORE_NAME = "SNAPSHOT"
+
+    def __init__(self, region, store=None, cases=None):
+        """
+        :param cases: a dict mapping case numbers to [fingerprints, timestamp,
+        last_seen] lists. The listing can include several rows for one case
+        number, so fingerprints is a list with the fingerprint of each row.
+        timestamp is the case's last update and last_seen is when a scan last
+        found it, both as POSIX timestamps.
+        """
+        super().__init__(region, store)
+        self.cases = cases or {}
+
+    @classmethod
+    def from_json(cls, region, store, data):
+        now = time.time()
+        cases = {}
+        for case_number, entry in (data or {}).items():
+            fingerprints, timestamp = entry[:2]
+            # Snapshots saved before duplicate rows were handled stored a
+            # single fingerprint, and older snapshots have no last_seen time.
+            if isinstance(fingerprints, str):
+                fingerprints = [fingerprints]
+            last_seen = entry[2] if len(entry) > 2 else now
+            cases[case_number] = [fingerprints, timestamp, last_seen]
+        return cls(region, store, cases)
+
+    def to_json(self):
+        return self.cases
+
+    def save(self):
+        cutoff = time.time() - SNAPSHOT_MAX_AGE
+        self.cases = {case_number: entry for case_number, entry
+                      in self.cases.items() if entry[2] >= cutoff}
+        super().save()
+
+    def changes(self, cases, window_start=None, date_column="updated_date"):
+        """Generates the cases that are new or have changed since the snapshot was
+        taken. The snapshot is only updated, and tombstones only generated,
+        once `cases` is exhausted. If producing `cases` raises an exception,
+        the snapshot is left as it was.
+
+        :param cases: an iterable of case dicts with a "fingerprint" key
+        :param window_start: a datetime. If provided, `cases` should include
+        every case updated after this time, and a tombstone is generated for
+        each case in the snapshot updated after `window_start` that is
+        missing from `cases`.
+
+        """
+        found = {}
+        seen_at = time.time()
+        for case in cases:
+            case_number = case["case_number"]
+            timestamp = case[date_column].timestamp()
+            fingerprints, latest = found.get(case_number, (set(), timestamp))
+            fingerprints.add(case["fingerprint"])
+            found[case_number] = (fingerprints, max(latest, timestamp))
+
+            entry = self.cases.get(case_number)
+            if not entry or case["fingerprint"] not in entry[0]:
+                yield case
+
+        for case_number, (fingerprints, timestamp) in found.items():
+            self.cases[case_number] = [sorted(fingerprints), timestamp,
+                                       seen_at]
+
+        if window_start:
+            start = window_start.timestamp()
+            for case_number, (_, timestamp, _) in list(self.cases.items()):
+                if timestamp > start and case_number not in found:
+                    del self.cases[case_number]
+                    yield {"case_number": case_number, "deleted": True}
@@ -7,6 +7,7 @@ import sys
 import traceback
 
 from urllib.parse import parse_qsl
+from wsgiref.simple_server import make_server
 
 logger = logging.getLogger(__name__)
 
@@ -89,10 +90,35 @@ def make_azure_request(env):
 def json_serialize(x):
     if isinstance(x, datetime):
         return x.isoformat()
+    if isinstance(x, (map, filter)) or hasattr(x, "__next__"):
+        return list(x)
 
     return str(x)
 
 
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(req):
+    return (req.GET or {}).get("format") == "ndjson"
+
+
+def ndjson_lines(response):
+    """Generates the lines of a newline-delimited JSON serialization of a handler
+    response. Each member of a list or generator value in the response is
+    serialized on its own line as it is produced, so the full response never
+    needs to be held in memory. Other values are serialized as a line of the
+    form {key: value}.
+
+    """
+    for key, val in response.items():
+        if isinstance(val, (list, tuple, map, filter)) or hasattr(val, "__next__"):
+            for item in val:
+                yield json.dumps(item, default=json_serialize) + "\n"
+        else:
+            yield json.dumps({key: val}, default=json_serialize) + "\n"
+
+
 def output(req, resp):
     with open(os.environ["RES"]) as out:
         out.write(json.dumps(resp, default=json_serialize))
@@ -167,6 +193,20 @@ def aws_lambda(fn):
 
         try:
             response = fn(req)
+
+            if isinstance(response, str):
+                return lambda_response(response)
+            if isinstance(response, dict):
+                # Generators in the response are consumed during
+                # serialization, so this must also happen inside the try.
+                if wants_ndjson(req):
+                    return lambda_response("".join(ndjson_lines(response)),
+                                           content_type=NDJSON_CONTENT_TYPE)
+                return lambda_response(
+                    json.dumps(response, default=json_serialize),
+                    content_type="application/json")
+            if callable(response):
+                return response(req)
         except Exception as exc:
             logger.exception(f"Exception thrown in handler: {handler_name}")
 
@@ -176,20 +216,81 @@ def aws_lambda(fn):
                 content_type="application/json"
             )
 
-        if isinstance(response, str):
-            return lambda_response(response)
-        if isinstance(response, dict):
-            return lambda_response(
-                json.dumps(response, default=json_serialize),
-                content_type="application/json")
-        if callable(response):
-            return response(req)
-
     do_run.__name__ = fn.__name__
     do_run.__module__ = fn.__module__
+    do_run.handler = fn
     return do_run
 
 
+def make_wsgi_request(environ):
+    headers = {key[5:].replace("_", "-").lower(): val
+               for key, val in environ.items() if key.startswith("HTTP_")}
+    if "CONTENT_TYPE" in environ:
+        headers["content-type"] = environ["CONTENT_TYPE"]
+
+    return Request(
+        method=environ["REQUEST_METHOD"],
+        headers=headers,
+        query=dict(parse_qsl(environ.get("QUERY_STRING", ""))),
+        path=environ.get("PATH_INFO", "/"),
+        body=environ.get("wsgi.input"))
+
+
+def wsgi(fn):
+    """Returns a WSGI application that runs a handler function, for running
+    handlers locally. With ?format=ndjson, the response body is streamed one
+    line at a time as the handler's generators produce values. Since the
+    status has already been sent by then, an exception partway through the
+    stream is reported as a final {"error": ...} line.
+
+    :param fn: function taking a request object, or a function decorated with
+    `aws_lambda`
+    """
+    fn = getattr(fn, "handler", fn)
+    handler_name = f"{fn.__module__}.{fn.__name__}"
+
+    def app(environ, start_response):
+        req = make_wsgi_request(environ)
+
+        def stream(lines):
+            try:
+                for line in lines:
+                    yield line.encode("utf-8")
+            except Exception:
+                logger.exception(f"Exception thrown in handler: {handler_name}")
+                error = {"error": f"Exception in {handler_name}"}
+                yield (json.dumps(error) + "\n").encode("utf-8")
+
+        try:
+            response = fn(req)
+            if isinstance(response, dict) and wants_ndjson(req):
+                start_response("200 OK", [("Content-Type", NDJSON_CONTENT_TYPE)])
+                return stream(ndjson_lines(response))
+
+            if isinstance(response, dict):
+                body = json.dumps(response, default=json_serialize)
+                content_type = "application/json"
+            else:
+                body, content_type = str(response), "text/plain"
+        except Exception:
+            logger.exception(f"Exception thrown in handler: {handler_name}")
+            start_response("500 Internal Server Error",
+                           [("Content-Type", "application/json")])
+            return [json.dumps({"error": f"Exception in {handler_name}"})
+                    .encode("utf-8")]
+
+        start_response("200 OK", [("Content-Type", content_type)])
+        return [body.encode("utf-8")]
+
+    return app
+
+
+def serve(fn, host="localhost", port=8000):
+    "Serve a handler function locally using wsgiref."
+    with make_server(host, port, wsgi(fn)) as server:
+        server.serve_forever()
+
+
 def cloud_fn(fn):
     if "AWS_REGION" in os.environ:
         return aws_lambda(fn)
@@ -0,0 +1,71 @@
+"""Fast date parsing for sources that use a handful of fixed formats.
+
+`dateutil.parser.parse` can handle almost anything, but it is slow. A
+`DateParser` first tries a short list of strict `strptime` formats, moving the
+format that last succeeded to the front of the list, so that a parser used for
+a single source quickly learns that source's format. It only falls back to
+dateutil when none of the formats match. Results are memoized, since the same
+date strings tend to repeat within a scrape.
+"""
+from datetime import datetime
+from functools import lru_cache
+import re
+
+from dateutil.parser import parse as dt_parse
+
+
+DEFAULT_FORMATS = [
+    "%Y-%m-%dT%H:%M:%S.%f",     # Socrata floating timestamps
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S%z",      # HTML content attributes
+    "%Y-%m-%d",
+    "%B %d, %Y",                # November 4, 2020
+    "%b %d, %Y",                # Nov 4, 2020
+    "%m/%d/%Y",
+]
+
+# Python 3.6's %z does not accept a colon in the UTC offset.
+UTC_OFFSET_COLON = re.compile(r"([+-]\d\d):(\d\d)$")
+
+
+class DateParser(object):
+    def __init__(self, formats=DEFAULT_FORMATS, memo_size=4096):
+        """
+        :param formats: strptime formats to try before falling back to dateutil
+        :param memo_size: the maximum number of parsed strings to remember
+        """
+        self.formats = list(formats)
+        self.counts = {"fast": 0, "fallback": 0}
+        self.parse = lru_cache(maxsize=memo_size)(self._parse)
+
+    def _parse(self, datestring, ignoretz=False):
+        """Parses `datestring`, returning a datetime. If `ignoretz` is True, any
+        time zone in the string is dropped and a naive datetime is returned.
+
+        Raises ValueError if the string cannot be parsed.
+
+        """
+        datestring = datestring.strip()
+        candidate = UTC_OFFSET_COLON.sub(r"\1\2", datestring)
+
+        formats = self.formats
+        for fmt in formats:
+            try:
+                dt = datetime.strptime(candidate, fmt)
+            except ValueError:
+                continue
+
+            if fmt is not formats[0]:
+                # Replace rather than mutate, since other threads may be
+                # iterating over the list.
+                self.formats = [fmt] + [f for f in formats if f is not fmt]
+            self.counts["fast"] += 1
+            return dt.replace(tzinfo=None) if ignoretz else dt
+
+        self.counts["fallback"] += 1
+        return dt_parse(datestring, ignoretz=ignoretz)
+
+    @property
+    def stats(self):
+        info = self.parse.cache_info()
+        return dict(self.counts, memo_hits=info.hits, memo_misses=info.misses)
@@ -1,30 +1,66 @@
 import boto3
+from botocore.exceptions import ProfileNotFound
 from datetime import datetime, timedelta
 from dateutil import parser as dt_parser
 import pytz
-import requests
 
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import hashlib
 import json
 import os
+import shutil
 import subprocess
 import tempfile
-from urllib.parse import unquote_plus, quote_plus
+import threading
+import time
+from urllib.parse import unquote_plus, quote_plus, urlsplit
 
+import http_client
 import somervillema
 # from . import cambridgema
 
 from extractors import extract, s3doc
-from extractors.utils import pdfinfo, pdf_to_text
+from extractors.utils import (DefaultExtractOpts, PdfInfo, parse_pdfinfo,
+                              pdfinfo, pdf_to_text, pdftotext_args)
 
-try:
-    Session = boto3.Session(profile_name="cornerwise")
-    S3 = Session.client("s3")
-except _:
-    S3 = boto3.client("s3")
+def make_s3_client():
+    """Creates an S3 client, using the "cornerwise" profile if it exists. Set
+    S3_ENDPOINT_URL to use an S3-compatible service instead of AWS, such as a
+    local stand-in for testing.
+    """
+    try:
+        session = boto3.Session(profile_name="cornerwise")
+    except ProfileNotFound:
+        session = boto3.Session()
+    return session.client("s3", endpoint_url=os.environ.get("S3_ENDPOINT_URL"))
+
+S3 = make_s3_client()
 
 
 BucketName = os.environ.get("DOCS_BUCKET", "cornerwise-docs-dev")
+# Optional path of a file listing the keys already uploaded to the bucket. If
+# the file exists, the downloader reads it instead of listing the bucket.
+IndexFile = os.environ.get("DOCS_INDEX_FILE")
+
+# The number of documents downloaded and uploaded concurrently
+DownloadWorkers = int(os.environ.get("DOCS_DOWNLOAD_WORKERS", "4"))
+UploadWorkers = int(os.environ.get("DOCS_UPLOAD_WORKERS", "4"))
+# The most concurrent downloads from any one host
+HostConcurrency = int(os.environ.get("DOCS_HOST_CONCURRENCY", "2"))
+# Downloaded documents larger than this are buffered on disk until uploaded
+SpoolSize = 8*1024*1024
+# "stream" pipes PDFs from S3 through pdftotext and back without touching
+# the disk; "file" works on local copies in a temporary directory
+ExtractMode = os.environ.get("DOCS_EXTRACT_MODE", "stream")
+ChunkSize = 64*1024
+# The number of uploaded PDFs extracted concurrently, and whether they are
+# extracted in a pool of "thread"s or "process"es. The work is done by
+# poppler subprocesses either way. Lambda has no /dev/shm, which
+# multiprocessing requires, so process pools only work elsewhere.
+ExtractWorkers = int(os.environ.get("DOCS_EXTRACT_WORKERS", "4"))
+ExtractPool = os.environ.get("DOCS_EXTRACT_POOL", "thread")
 
 CaseLoaders = {
     "somervillema": somervillema,
@@ -35,24 +71,12 @@ def extract_doc_attributes(bucket, key):
     doc = s3doc.S3Doc(bucket, key)
     return extract.get_properties(doc)
 
-def extract_text(bucket, key):
-    """Uses pdftotext to extract the text of a PDF and writes the resulting text
-    file back to the bucket
-
+def add_document_dates(metadata, info_data):
+    """Adds the creation and modification dates reported by pdfinfo to the
+    document's metadata
     """
-    local_dir = tempfile.mkdtemp()
-    basename = os.path.basename(key)
-    local_file = os.path.join(local_dir, basename)
-
-    print(bucket, key, local_file)
-
-    S3.download_file(bucket, key, local_file)
-
-    response = S3.get_object(Bucket=bucket, Key=key)
-    metadata = response.get("Metadata", {})
     try:
         TZ = pytz.timezone(metadata.get("timezone", "US/Eastern"))
-        info_data = pdfinfo(local_file)
         if "CreationDate" in info_data:
             cdate = dt_parser.parse(info_data["CreationDate"])
             metadata["doc_created"] = TZ.localize(cdate).isoformat()
@@ -62,58 +86,462 @@ def extract_text(bucket, key):
     except Exception as err:
         print(err)
 
-    text_file = os.path.join(local_dir, f"{basename}.txt")
-    pdf_to_text(local_file, text_file)
-    stripped_name = os.path.splitext(basename)[0]
-    out_path = os.path.join(os.path.dirname(key), f"{stripped_name}.txt")
-    S3.upload_file(text_file, bucket, out_path,
-                   ExtraArgs={ "StorageClass": "STANDARD_IA",
-                               "ACL": "public-read",
-                               "Metadata": metadata
-                   })
-
-def download_docs(since):
-    """Upload recent documents to the bucket
+def text_key(key):
+    stripped_name = os.path.splitext(os.path.basename(key))[0]
+    return os.path.join(os.path.dirname(key), f"{stripped_name}.txt")
+
+def text_upload_args(metadata):
+    return { "StorageClass": "STANDARD_IA",
+             "ACL": "public-read",
+             "Metadata": metadata }
+
+def tee(infile, outfiles):
+    """Copies `infile` to each of `outfiles`, closing them at the end. Stops
+    writing to an output whose reader has exited.
+    """
+    outfiles = list(outfiles)
+    try:
+        for chunk in iter(lambda: infile.read(ChunkSize), b""):
+            for outfile in list(outfiles):
+                try:
+                    outfile.write(chunk)
+                except BrokenPipeError:
+                    outfiles.remove(outfile)
+            if not outfiles:
+                break
+    finally:
+        for outfile in outfiles:
+            try:
+                outfile.close()
+            except BrokenPipeError:
+                pass
+
+class CheckedOutput(object):
+    """Reads the output of a process, raising CalledProcessError at the end of
+    the output if the process failed, so that a partial result is never
+    uploaded
+    """
+    def __init__(self, proc):
+        self.proc = proc
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and self.proc.wait():
+            raise subprocess.CalledProcessError(self.proc.returncode,
+                                                self.proc.args)
+        return data
+
+def extract_text_streaming(bucket, key, client=None):
+    """Fetches the PDF from the bucket once, piping it into pdfinfo and
+    pdftotext concurrently, and streams the text back to the bucket as a
+    (multipart) upload. Nothing is written to the disk; poppler keeps each PDF
+    in memory while it is read.
+    """
+    client = client or S3
+    response = client.get_object(Bucket=bucket, Key=key)
+    metadata = response.get("Metadata", {})
+
+    info = subprocess.Popen([PdfInfo, "fd://0"], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    text = subprocess.Popen([*pdftotext_args(DefaultExtractOpts), "fd://0", "-"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    feeder = threading.Thread(target=tee,
+                              args=(response["Body"], [info.stdin, text.stdin]))
+    feeder.start()
+    try:
+        # pdfinfo and pdftotext only produce output once they have read the
+        # whole PDF, so the metadata is ready before the text upload starts.
+        info_output = info.stdout.read().decode(errors="replace")
+        if info.wait() == 0:
+            add_document_dates(metadata, parse_pdfinfo(info_output))
+
+        client.upload_fileobj(CheckedOutput(text), bucket, text_key(key),
+                              ExtraArgs=text_upload_args(metadata))
+    finally:
+        for proc in (info, text):
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        feeder.join()
+
+def extract_text_file(bucket, key, client=None):
+    """Fetches the PDF from the bucket once into a temporary directory, which is
+    removed afterward, and uploads the extracted text to the bucket.
     """
+    client = client or S3
+    response = client.get_object(Bucket=bucket, Key=key)
+    metadata = response.get("Metadata", {})
+    basename = os.path.basename(key)
+
+    with tempfile.TemporaryDirectory() as local_dir:
+        local_file = os.path.join(local_dir, basename)
+        with open(local_file, "wb") as outfile:
+            shutil.copyfileobj(response["Body"], outfile, ChunkSize)
+
+        try:
+            add_document_dates(metadata, pdfinfo(local_file))
+        except Exception as err:
+            print(err)
+
+        text_file = os.path.join(local_dir, f"{basename}.txt")
+        pdf_to_text(local_file, text_file)
+        client.upload_file(text_file, bucket, text_key(key),
+                           ExtraArgs=text_upload_args(metadata))
+
+def extract_text(bucket, key, client=None, mode=ExtractMode):
+    """Uses pdftotext to extract the text of a PDF and writes the resulting text
+    file back to the bucket
+
+    """
+    print(bucket, key, mode)
+
+    if mode == "file":
+        extract_text_file(bucket, key, client)
+    else:
+        extract_text_streaming(bucket, key, client)
+
+def document_key(region, case, url):
+    url_hash = hashlib.sha1(url.encode()).hexdigest()
+    ext = os.path.splitext(url)[1]
+    return os.path.join(region, quote_plus(case["case_number"]),
+                        f"{url_hash}{ext}")
+
+def list_keys(bucket, prefix, client=None):
+    """Returns the set of keys in the bucket that start with `prefix`. Requires
+    s3:ListBucket on the bucket itself, not just on its objects.
+    """
+    keys = set()
+    paginator = (client or S3).get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.update(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+def load_index(regions, bucket=BucketName, index_file=IndexFile, client=None):
+    """Returns a dict mapping the keys already uploaded for the given regions to
+    the validators of the origin documents (see `origin_validators`), or to
+    None where they have not been looked up yet. The index is read from the
+    index file if there is one, or else built by listing the bucket.
+    """
+    if index_file:
+        try:
+            with open(index_file) as infile:
+                index = json.load(infile)
+            if isinstance(index, list):
+                return dict.fromkeys(index)
+            return index
+        except FileNotFoundError:
+            pass
+
+    index = {}
+    for region in regions:
+        index.update(dict.fromkeys(list_keys(bucket, f"{region}/", client)))
+    return index
+
+def save_index(index, index_file=IndexFile):
+    if not index_file:
+        return
+
+    directory = os.path.dirname(os.path.abspath(index_file))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as outfile:
+        json.dump(index, outfile, sort_keys=True)
+    os.replace(tmp_path, index_file)
+
+# Response headers saved in the metadata of each uploaded document, so that
+# later runs can tell whether the origin has changed
+ValidatorHeaders = {
+    "origin_etag": "ETag",
+    "origin_last_modified": "Last-Modified",
+    "origin_length": "Content-Length",
+}
+
+def origin_validators(response):
+    return {field: response.headers[header]
+            for field, header in ValidatorHeaders.items()
+            if response.headers.get(header)}
+
+def stored_validators(bucket, key, client=None):
+    response = (client or S3).head_object(Bucket=bucket, Key=key)
+    metadata = response.get("Metadata", {})
+    return {field: metadata[field] for field in ValidatorHeaders
+            if metadata.get(field)}
+
+def origin_unchanged(stored, current):
+    if stored.get("origin_etag") and current.get("origin_etag"):
+        return stored["origin_etag"] == current["origin_etag"]
+
+    if stored.get("origin_last_modified") and current.get("origin_last_modified"):
+        return all(stored.get(field) == current.get(field)
+                   for field in ["origin_last_modified", "origin_length"])
+
+    return False
+
+def conditional_headers(validators):
+    headers = {}
+    if validators.get("origin_etag"):
+        headers["If-None-Match"] = validators["origin_etag"]
+    if validators.get("origin_last_modified"):
+        headers["If-Modified-Since"] = validators["origin_last_modified"]
+    return headers
+
+def record_validators(url, key, client=None):
+    """For a document archived before validators were recorded, looks up the
+    origin's current validators with a HEAD request and adds them to the
+    object's metadata, so that later runs can detect changes. The archived
+    copy is assumed to be current.
+
+    :returns: the validators, which are empty if the origin provides none
+    """
+    client = client or S3
+    response = http_client.head(url, allow_redirects=True)
+    validators = origin_validators(response) if response.status_code == 200 else {}
+    if not validators:
+        return validators
+
+    head = client.head_object(Bucket=BucketName, Key=key)
+    client.copy_object(Bucket=BucketName, Key=key,
+                       CopySource={"Bucket": BucketName, "Key": key},
+                       MetadataDirective="REPLACE",
+                       Metadata={**head.get("Metadata", {}), **validators},
+                       ContentType=head.get("ContentType", "binary/octet-stream"),
+                       StorageClass="STANDARD_IA",
+                       ACL="public-read")
+    return validators
+
+def fetch_if_changed(url, validators):
+    """Requests the document at `url`, unless it is known to be unchanged since
+    it was uploaded with the given validators.
+
+    :returns: a streaming response, or None if the document is unchanged
+    """
+    headers = conditional_headers(validators or {})
+    response = http_client.get(url, stream=True, headers=headers)
+    if response.status_code == 304 or \
+       (validators and origin_unchanged(validators, origin_validators(response))):
+        response.close()
+        return None
+
+    return response
+
+DocumentJob = namedtuple("DocumentJob", ["region", "module", "case", "doc", "key"])
+
+def document_jobs(since):
     for region, module in CaseLoaders.items():
-        region_name = module.REGION_NAME
-        cases = module.get_proposals_since(since)
-        for case in cases:
-            addresses = case["all_addresses"]
-            address = "".join(addresses[0:1])
+        for case in module.get_proposals_since(since):
             for doc in case["documents"]:
-                url = doc['url']
-                url_hash = hashlib.sha1(url.encode()).hexdigest()
-                ext = os.path.splitext(url)[1]
-                out_key = os.path.join(
-                    region, quote_plus(case["case_number"]), f"{url_hash}{ext}")
-                print(f"Downloading {url} -> {out_key}")
-
-                req = requests.get(url, stream=True)
-                S3.upload_fileobj(req.raw, BucketName, out_key,
-                                  ExtraArgs={ "StorageClass": "STANDARD_IA",
-                                              "ACL": "public-read",
-                                              "Metadata": {
-                                                  "origin": url,
-                                                  "document_title": doc.get("title", ""),
-                                                  "tags": json.dumps(doc.get("tags", [])),
-                                                  "timezone": module.TIMEZONE.zone,
-                                                  "case_number": case["case_number"],
-                                                  "address": address,
-                                                  "addresses": json.dumps(addresses),
-                                                  "region": region_name,
-                                                  "region_id": region,
-                                                  "field": doc.get("field", "")
-                                              }
-                                  })
+                yield DocumentJob(region, module, case, doc,
+                                  document_key(region, case, doc["url"]))
+
+def document_metadata(job, validators):
+    case, doc = job.case, job.doc
+    addresses = case["all_addresses"]
+    return {
+        "origin": doc["url"],
+        **validators,
+        "document_title": doc.get("title", ""),
+        "tags": json.dumps(doc.get("tags", [])),
+        "timezone": job.module.TIMEZONE.zone,
+        "case_number": case["case_number"],
+        "address": "".join(addresses[0:1]),
+        "addresses": json.dumps(addresses),
+        "region": job.module.REGION_NAME,
+        "region_id": job.region,
+        "field": doc.get("field", "")
+    }
+
+class HostLimits(object):
+    "Limits the number of concurrent requests to each host."
+    def __init__(self, limit=HostConcurrency):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            semaphore = self.semaphores[host]
+        with semaphore:
+            yield
+
+class Progress(object):
+    "Counts documents and bytes as they move through the download pipeline."
+    def __init__(self):
+        self.counts = dict.fromkeys(["documents", "skipped", "downloaded",
+                                     "uploaded", "failed", "bytes"], 0)
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counts[counter] += n
+
+    def summary(self):
+        with self.lock:
+            result = dict(self.counts)
+        elapsed = max(time.time() - self.started, 1e-6)
+        result["seconds"] = elapsed
+        result["documents_per_second"] = result["uploaded"] / elapsed
+        result["bytes_per_second"] = result["bytes"] / elapsed
+        return result
+
+    def report(self):
+        summary = self.summary()
+        print("{documents} documents: {uploaded} uploaded, {skipped} unchanged, "
+              "{failed} failed in {seconds:.1f}s "
+              "({documents_per_second:.2f} docs/s, "
+              "{bytes_per_second:.0f} bytes/s)".format(**summary))
+
+def download_docs(since, index_file=IndexFile, client=None,
+                  download_workers=DownloadWorkers, upload_workers=UploadWorkers,
+                  host_concurrency=HostConcurrency):
+    """Upload recent documents to the bucket, skipping those that were uploaded
+    by an earlier run and have not changed at the origin since. Documents are
+    downloaded and uploaded by separate pools of workers, with at most
+    `host_concurrency` downloads from each host at a time.
+
+    :returns: a dict of counts and throughput (see `Progress`)
+    """
+    client = client or S3
+    index = load_index(CaseLoaders, BucketName, index_file, client)
+    progress = Progress()
+    host_limits = HostLimits(host_concurrency)
+    # Bounds the number of downloaded documents waiting to be uploaded
+    in_flight = threading.BoundedSemaphore(download_workers + upload_workers)
+
+    def upload(job, body, validators):
+        try:
+            with body:
+                client.upload_fileobj(body, BucketName, job.key,
+                                      ExtraArgs={ "StorageClass": "STANDARD_IA",
+                                                  "ACL": "public-read",
+                                                  "Metadata": document_metadata(job, validators)
+                                      })
+            index[job.key] = validators
+            progress.count("uploaded")
+        except Exception as err:
+            print(f"Failed to upload {job.key}: {err}")
+            progress.count("failed")
+        finally:
+            in_flight.release()
+
+    def download(job):
+        url = job.doc["url"]
+        body = None
+        try:
+            validators = index.get(job.key)
+            if job.key in index and validators is None:
+                validators = stored_validators(BucketName, job.key, client)
+                index[job.key] = validators
+
+            with host_limits.acquire(url):
+                if validators == {}:
+                    # Archived before validators were recorded
+                    index[job.key] = record_validators(url, job.key, client)
+                    progress.count("skipped")
+                    in_flight.release()
+                    return
+
+                req = fetch_if_changed(url, validators)
+                if req is None:
+                    progress.count("skipped")
+                    in_flight.release()
+                    return
+                if req.status_code != 200:
+                    print(f"Skipping {url}: {req.status_code}")
+                    req.close()
+                    progress.count("failed")
+                    in_flight.release()
+                    return
+
+                print(f"Downloading {url} -> {job.key}")
+                body = tempfile.SpooledTemporaryFile(SpoolSize)
+                with req:
+                    req.raw.decode_content = True
+                    shutil.copyfileobj(req.raw, body)
+
+            progress.count("downloaded")
+            progress.count("bytes", body.tell())
+            body.seek(0)
+            upload_pool.submit(upload, job, body, origin_validators(req))
+        except Exception as err:
+            print(f"Failed to download {url}: {err}")
+            if body:
+                body.close()
+            progress.count("failed")
+            in_flight.release()
+
+    try:
+        # The download pool is shut down first, so that every download has
+        # submitted its upload before the upload pool is shut down.
+        with ThreadPoolExecutor(upload_workers) as upload_pool, \
+             ThreadPoolExecutor(download_workers) as download_pool:
+            for job in document_jobs(since):
+                progress.count("documents")
+                in_flight.acquire()
+                download_pool.submit(download, job)
+    finally:
+        save_index(index, index_file)
+        progress.report()
+
+    return progress.summary()
+
+def s3_records(record):
+    """Returns the S3 notification records in an event record, which is either
+    an S3 record or an SQS message wrapping an S3 notification
+    """
+    if "s3" in record:
+        return [record]
+    if "body" in record:
+        # S3 test events have no Records
+        return json.loads(record["body"]).get("Records", [])
+    return []
+
+def record_id(record):
+    if "messageId" in record:
+        return record["messageId"]
+    s3 = record["s3"]
+    return f"{s3['bucket']['name']}/{s3['object']['key']}"
+
+def extract_record(record):
+    for s3_record in s3_records(record):
+        s3 = s3_record["s3"]
+        extract_text(s3["bucket"]["name"], unquote_plus(s3["object"]["key"]))
+
+def extract_batch(records, workers=ExtractWorkers, pool=ExtractPool):
+    """Extracts the text of the PDFs in all of the records concurrently.
+
+    :returns: the ids (see `record_id`) of the records that failed
+    """
+    Executor = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+    failures = []
+    with Executor(max_workers=workers) as executor:
+        futures = [(record, executor.submit(extract_record, record))
+                   for record in records]
+        for record, future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                print(f"Failed to extract {record_id(record)}: {err}")
+                failures.append(record_id(record))
+    return failures
 
 def doc_uploaded(event, context):
-    s3 = event["Records"][0]["s3"]
-    s3obj = s3["object"]
-    bucket = s3["bucket"]
-    key = unquote_plus(s3obj["key"])
+    """Handles S3 upload notifications, delivered directly or through SQS. For
+    SQS, the failed messages are reported for partial batch retries; direct
+    S3 events are retried as a whole if any record fails.
+    """
+    records = event.get("Records", [])
+    failures = extract_batch(records)
+    if failures and not all("messageId" in record for record in records):
+        raise RuntimeError(f"Failed to extract {', '.join(failures)}")
 
-    extract_text(bucket["name"], key)
+    return {"batchItemFailures": [{"itemIdentifier": failure}
+                                  for failure in failures]}
 
 def download(event, context):
     download_docs(datetime.now() - timedelta(days=7))
@@ -5,9 +5,10 @@ contents.
 from collections import OrderedDict
 import re
 
-from dateutil.parser import parse as dt_parse
 import pytz
 
+from dates import DateParser
+
 from .s3doc import S3Doc
 from .utils import pushback_iter
 
@@ -218,6 +219,7 @@ def remove_match(s, m):
 
 
 ALL_EXTRACTORS = []
+DECISION_DATES = DateParser()
 
 def extractor(*preds):
     def decorator_fn(process):
@@ -299,9 +301,9 @@ def staff_report_properties(doc):
         pass
 
     if "Recommendation" in attrs:
-        if re.match(r"^(?i)(conditional )?approval", attrs["Recommendation"]):
+        if re.match(r"(?i)^(conditional )?approval", attrs["Recommendation"]):
             props["status"] = "Recommend Approval"
-        elif re.match(r"^(?i)denial", attrs["Recommendation"]):
+        elif re.match(r"(?i)^denial", attrs["Recommendation"]):
             props["status"] = "Recommend Denial"
 
     desc_section = sections.get("project description")
@@ -361,7 +363,7 @@ def decision_properties(doc):
 
     try:
         props["complete"] = pytz.timezone("US/Eastern").localize(
-            dt_parse(attrs["Date of Decision"])).isoformat()
+            DECISION_DATES.parse(attrs["Date of Decision"])).isoformat()
     except (ValueError, KeyError):
         props["complete"] = doc.published.isoformat()
 
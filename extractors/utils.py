@@ -1,3 +1,5 @@
+from collections import deque
+import io
 from os import path
 import re
 import subprocess
@@ -44,10 +46,11 @@ def parse_pdf_dims(dims):
 
     return (None, None)
 
+def parse_pdfinfo(output):
+    return dict(re.findall(r"([\w ]+):\s+([^\n]*)\n", output))
+
 def pdfinfo(path):
-    return dict(re.findall(
-        r"([\w ]+):\s+([^\n]*)\n",
-        subprocess.check_output([PdfInfo, path]).decode()))
+    return parse_pdfinfo(subprocess.check_output([PdfInfo, path]).decode())
 
 def pdf_dims(path):
     info = pdfinfo(path)
@@ -68,16 +71,56 @@ def prepare_pdfextract_args(opts, dims=None):
     return sum([[f"-{kopt}"] if v is True else [f"-{kopt}", str(v)]
                 for kopt, v in opts.items() if not kopt.startswith("margin")], [])
 
-def pdf_to_text(pdf_path, out_file, extra_opts=DefaultExtractOpts):
+def has_pdftotext():
+    "Returns True if the poppler tools are installed (e.g., by the layer)."
+    return path.exists(PdfToText)
+
+def pdftotext_args(extra_opts, first_page=None, last_page=None):
     opts = { "enc": "UTF-8" }
     opts.update(extra_opts)
+    if first_page:
+        opts["f"] = first_page
+    if last_page:
+        opts["l"] = last_page
+
+    return [PdfToText, *prepare_pdfextract_args(opts)]
 
-    args = [PdfToText, *prepare_pdfextract_args(opts)]
-    kwargs = {}
+def pdf_to_text(pdf_path, out_file, extra_opts=DefaultExtractOpts,
+                first_page=None, last_page=None):
+    """Extracts the text of the PDF at `pdf_path` (or "fd://0" for stdin) to
+    `out_file`, which is either a path or a file object.
+    """
+    args = [*pdftotext_args(extra_opts, first_page, last_page), pdf_path]
     if isinstance(out_file, str):
-        args.append(out_file)
+        subprocess.check_call([*args, out_file])
     else:
-        args.append("-")
-        kwargs["stdout"] = out_file
+        subprocess.check_call([*args, "-"], stdout=out_file)
 
-    subprocess.check_output(args, **kwargs)
+def pdf_pages(pdf_path, extra_opts=DefaultExtractOpts, first_page=None,
+              last_page=None, chunk_size=8192):
+    """Generates the text of each page of the PDF at `pdf_path` as pdftotext
+    produces it, so that only one page at a time is held in memory. If the
+    consumer stops early, pdftotext is stopped as well.
+    """
+    args = [*pdftotext_args(extra_opts, first_page, last_page), pdf_path, "-"]
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    finished = False
+    try:
+        reader = io.TextIOWrapper(proc.stdout, encoding="utf-8",
+                                  errors="replace")
+        partial = ""
+        for chunk in iter(lambda: reader.read(chunk_size), ""):
+            # pdftotext ends each page with a form feed
+            *pages, partial = (partial + chunk).split("\f")
+            yield from pages
+        if partial.strip():
+            yield partial
+        finished = True
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+    if finished and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
@@ -3,20 +3,27 @@ next scheduled meeting.
 """
 from datetime import datetime, time, timedelta
 import re
-from urllib.request import urlopen
+from urllib.error import HTTPError
 
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import NavigableString
 from dateutil.parser import parse
 import pytz
 
 from cloud import aws_lambda
+import http_cache
+from scrape_utils import make_soup
 
 
 TIMEZONE = pytz.timezone("US/Eastern")
+URL = "http://greenlineextension.org"
 
 def get_doc():
-    with urlopen("http://greenlineextension.org") as u:
-        return BeautifulSoup(u.read(), "html.parser")
+    response = http_cache.fetch(URL)
+    if response.status_code != 200:
+        raise HTTPError(URL, response.status_code,
+                        f"Green Line request failed: {response.status_code}",
+                        response.headers, None)
+    return make_soup(response.content)
 
 
 def find_text_elem(elem, regex, tags={"tr"}):
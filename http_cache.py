@@ -0,0 +1,179 @@
+"""A caching fetch layer for scraper pages.
+
+Responses that carry an ETag or Last-Modified header are kept in a store (see
+`stores`) along with those validators. Subsequent fetches of the same URL send
+If-None-Match/If-Modified-Since, and when the server responds with 304 Not
+Modified, the stored body is returned instead.
+
+Configure the default cache with HTTP_CACHE_DIR or HTTP_CACHE_BUCKET (see
+`stores.store_from_env`), HTTP_CACHE_MAX_BYTES and HTTP_CACHE_MAX_AGE (in
+seconds). Set HTTP_CACHE_DISABLED to skip caching entirely.
+"""
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import http_client
+import stores
+
+
+logger = logging.getLogger(__name__)
+
+CachedResponse = namedtuple("CachedResponse",
+                            ["url", "status_code", "content", "headers",
+                             "from_cache"])
+
+# Check the size and age limits after this many writes:
+EVICT_EVERY = 100
+
+
+class HTTPCache(object):
+    def __init__(self, store, max_bytes=None, max_age=None, max_entries=None):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.counters = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] += n
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def load(self, url):
+        """Returns a (metadata, body) tuple for a cached URL, or (None, None) if
+        it is not cached.
+
+        """
+        data = self.store.get(self.key(url))
+        if not data:
+            return None, None
+
+        meta, body = data.split(b"\n", 1)
+        meta = json.loads(meta.decode("utf-8"))
+        # Guard against hash collisions:
+        if meta.get("url") != url:
+            return None, None
+
+        return meta, body
+
+    def save(self, url, response):
+        meta = {"url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "content_type": response.headers.get("Content-Type"),
+                "stored": time.time()}
+        data = json.dumps(meta).encode("utf-8") + b"\n" + response.content
+        self.store.put(self.key(url), data)
+        self._count("stored")
+
+        with self._lock:
+            self._writes += 1
+            should_evict = self._writes % EVICT_EVERY == 1
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        if self.max_bytes is None and self.max_age is None and \
+           self.max_entries is None:
+            return
+        self._count("evicted", stores.evict(self.store, self.max_bytes,
+                                            self.max_age, self.max_entries))
+
+    def fetch(self, url, headers=None):
+        """Performs a GET request for the given URL, using the cached body if the
+        server reports that it has not changed.
+
+        :returns: a CachedResponse
+
+        """
+        headers = dict(headers or {})
+        try:
+            meta, body = self.load(url)
+        except Exception as err:
+            logger.warning("Failed to read cache entry for %s: %s", url, err)
+            meta, body = None, None
+
+        if meta:
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["last_modified"]:
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = http_client.get(url, headers=headers)
+
+        if meta and response.status_code == 304:
+            self._count("hits")
+            response_headers = dict(response.headers)
+            response_headers.setdefault("Content-Type", meta["content_type"])
+            return CachedResponse(url, 200, body, response_headers, True)
+
+        self._count("misses")
+        if response.status_code == 200 and \
+           ("ETag" in response.headers or "Last-Modified" in response.headers):
+            try:
+                self.save(url, response)
+            except Exception as err:
+                logger.warning("Failed to cache %s: %s", url, err)
+
+        return CachedResponse(url, response.status_code, response.content,
+                              response.headers, False)
+
+    @property
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class NullCache(HTTPCache):
+    "Performs uncached fetches, but still keeps counts."
+    def __init__(self):
+        super().__init__(None)
+
+    def load(self, url):
+        return None, None
+
+    def save(self, url, response):
+        pass
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def _env_number(name):
+    val = os.environ.get(name)
+    return int(val) if val else None
+
+
+def default_cache():
+    global _default_cache
+
+    with _default_lock:
+        if _default_cache is None:
+            if os.environ.get("HTTP_CACHE_DISABLED"):
+                _default_cache = NullCache()
+            else:
+                _default_cache = HTTPCache(
+                    stores.store_from_env("HTTP_CACHE"),
+                    max_bytes=_env_number("HTTP_CACHE_MAX_BYTES") or 64*1024*1024,
+                    max_age=_env_number("HTTP_CACHE_MAX_AGE") or 30*24*60*60)
+
+    return _default_cache
+
+
+def fetch(url, headers=None):
+    "Fetch a URL using the default cache."
+    return default_cache().fetch(url, headers)
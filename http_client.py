@@ -0,0 +1,133 @@
+"""A shared HTTP client for the scrapers.
+
+All requests go through a single `requests.Session`, which keeps a pool of
+keep-alive connections for each host so that repeated requests to the same
+site skip the TCP and TLS handshakes. Requests that fail with a connection
+error, a timeout or a 5xx response are retried with exponential backoff and
+jitter.
+
+Configure with HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT (in seconds),
+HTTP_MAX_RETRIES and HTTP_POOL_SIZE (connections per host).
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = (float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5")),
+           float(os.environ.get("HTTP_READ_TIMEOUT", "30")))
+MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+RETRY_STATUSES = {500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+
+USER_AGENT = "cornerwise-scrapers (+https://github.com/codeforboston/cornerwise-scrapers)"
+
+_session = None
+_session_lock = threading.Lock()
+_counters = {"requests": 0, "retries": 0, "failures": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(counter):
+    with _counters_lock:
+        _counters[counter] += 1
+
+
+def make_session(pool_size=POOL_SIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate",
+                            "User-Agent": USER_AGENT})
+    return session
+
+
+def session():
+    "Returns the shared Session, creating it if necessary."
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+
+    return _session
+
+
+def backoff(attempt):
+    "Returns the delay before the given retry, with 'full jitter'."
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def request(method, url, retries=MAX_RETRIES, timeout=TIMEOUT, **kwargs):
+    """Sends a request using the shared session, retrying on connection errors,
+    timeouts and 5xx responses. Takes the same keyword arguments as
+    `requests.request`.
+
+    :returns: a `requests.Response`. If the retries are exhausted, the last
+    5xx response is returned, or the last exception is raised.
+
+    """
+    for attempt in range(retries + 1):
+        _count("requests")
+        try:
+            response = session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if attempt == retries:
+                _count("failures")
+                raise
+            logger.warning("%s %s failed (%s); retrying", method, url, err)
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            if attempt == retries:
+                _count("failures")
+                return response
+            logger.warning("%s %s returned %d; retrying", method, url,
+                           response.status_code)
+            response.close()
+
+        _count("retries")
+        time.sleep(backoff(attempt))
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request("HEAD", url, **kwargs)
+
+
+def stats():
+    """Returns counts of requests, retries and failures, along with the number
+    of connections opened and reused by the connection pools.
+
+    """
+    with _counters_lock:
+        result = dict(_counters)
+
+    opened = pooled_requests = 0
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            poolmanager = getattr(adapter, "poolmanager", None)
+            if not poolmanager:
+                continue
+            for key in poolmanager.pools.keys():
+                pool = poolmanager.pools.get(key)
+                if pool:
+                    opened += pool.num_connections
+                    pooled_requests += pool.num_requests
+
+    result["connections_opened"] = opened
+    result["connections_reused"] = max(0, pooled_requests - opened)
+    return result
@@ -2,16 +2,216 @@
 
 
 """
-from collections import defaultdict
+import atexit
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from functools import reduce
+from functools import reduce, wraps
+import json
+import os
 import re
+import sys
+import threading
+import time
+from types import GeneratorType
 
 import bs4
-from dateutil.parser import parse as dt_parse
+from bs4.builder import builder_registry
 import pytz
+import soupsieve
 import usaddress
 
+from dates import DateParser
+
+
+def available_parsers(candidates=("lxml", "html5lib", "html.parser")):
+    "Returns the names of the HTML parser backends that are installed."
+    return [name for name in candidates if builder_registry.lookup(name)]
+
+
+# The parser backend used by make_soup(). Defaults to lxml, which is much
+# faster than the pure-Python html.parser, if it is installed.
+HTML_PARSER = os.environ.get("HTML_PARSER") or available_parsers()[0]
+
+
+def make_soup(markup, parser=None, **kwargs):
+    """Parse an HTML document using the configured parser backend.
+
+    :param markup: a string or bytes containing HTML
+    :param parser: override the configured backend (e.g., "html.parser")
+
+    Additional keyword arguments are passed to BeautifulSoup.
+    """
+    return bs4.BeautifulSoup(markup, parser or HTML_PARSER, **kwargs)
+
+
+class Profiler(object):
+    """Records the number of calls, the cumulative time and the total size of
+    the results of each part of a scrape instruction, keyed by its path in the
+    instruction. Dict keys are joined with ".", "[]" marks the members of a
+    list selection, ":" separates a tuple's path from the label of one of its
+    steps, and "?N" marks the Nth filter of a list selection. For example:
+
+        documents               time spent on the whole "documents" value
+        documents:[span.file a] the list selection within it
+        documents[].url         the "url" key of each selected document
+        rows:[tr]?1:text        a step of the first filter applied to "tr"s
+
+    Times are cumulative, so a path's time includes the time of the paths
+    nested below it.
+    """
+    def __init__(self):
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def measure(self, path, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                entry = self.entries[path] = {"calls": 0, "time": 0.0, "size": 0}
+            entry["calls"] += 1
+            entry["time"] += elapsed
+            entry["size"] += _result_size(result)
+
+        return result
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def to_json(self):
+        "Returns the entries as a list of dicts, slowest first."
+        with self._lock:
+            entries = [dict(entry, path=path)
+                       for path, entry in self.entries.items()]
+        return sorted(entries, key=lambda entry: entry["time"], reverse=True)
+
+    def report(self, limit=None):
+        "Returns a table of the entries as a string, slowest first."
+        lines = [f"{'path':<50} {'calls':>8} {'total ms':>10} "
+                 f"{'per call us':>12} {'results':>8}"]
+        for entry in self.to_json()[:limit]:
+            lines.append(f"{entry['path']:<50} {entry['calls']:>8} "
+                         f"{entry['time'] * 1000:>10.2f} "
+                         f"{entry['time'] / entry['calls'] * 1e6:>12.1f} "
+                         f"{entry['size']:>8}")
+        return "\n".join(lines)
+
+    def dump(self, path=None):
+        """Writes the entries as JSON if `path` ends with ".json", or the report
+        to `path` or, without a path, to stderr.
+
+        """
+        if path and path.endswith(".json"):
+            with open(path, "w") as outfile:
+                json.dump(self.to_json(), outfile, indent=2)
+        elif path:
+            with open(path, "w") as outfile:
+                outfile.write(self.report() + "\n")
+        else:
+            print(self.report(), file=sys.stderr)
+
+
+def _result_size(result):
+    if result is None:
+        return 0
+    if isinstance(result, (list, dict, str)):
+        return len(result)
+    return 1
+
+
+# The active Profiler, or None when profiling is disabled (the default). Set
+# SCRAPE_PROFILE to profile the whole run and dump the results at exit: to
+# stderr if it is "1", otherwise to the named file (as JSON if the name ends
+# with ".json").
+_profiler = None
+
+if os.environ.get("SCRAPE_PROFILE"):
+    _profiler = Profiler()
+    atexit.register(_profiler.dump,
+                    None if os.environ["SCRAPE_PROFILE"] == "1"
+                    else os.environ["SCRAPE_PROFILE"])
+
+
+@contextmanager
+def profiling(profiler=None):
+    """Records the time spent in each part of the instructions applied within
+    the block, including those applied by compiled plans.
+
+        with profiling() as profiler:
+            get_events(doc)
+        print(profiler.report())
+
+    """
+    global _profiler
+
+    saved = _profiler
+    _profiler = profiler or Profiler()
+    try:
+        yield _profiler
+    finally:
+        _profiler = saved
+
+
+def _named(fn, name):
+    "Gives a function built by the DSL a readable name for profiling reports."
+    fn.__name__ = name
+    return fn
+
+
+def _label(instruction):
+    if isinstance(instruction, str):
+        return instruction
+    if isinstance(instruction, list):
+        return f"[{instruction[0]}]"
+    if isinstance(instruction, dict):
+        return "{}"
+    if isinstance(instruction, tuple):
+        return "()"
+    pattern = getattr(instruction, "pattern", None)
+    if pattern:
+        return f"/{pattern}/"
+    return getattr(instruction, "__name__", type(instruction).__name__)
+
+
+def _step_path(path, instruction):
+    label = _label(instruction)
+    return f"{path}:{label}" if path else label
+
+
+def _profiled_tuple(elt, instruction, path):
+    result = elt
+    # Steps applied to each member of a list (flattened, if there are nested
+    # lists) share one path
+    member_path = path + "[]"
+    for step in instruction:
+        if isinstance(result, list):
+            new_result = []
+            for member in result:
+                add = _profiled_step(member, step, member_path)
+                if isinstance(add, (list, map)):
+                    new_result += add
+                else:
+                    new_result.append(add)
+            result = new_result
+        elif result:
+            result = _profiled_step(result, step, path)
+    return result
+
+
+def _profiled_step(elt, instruction, path):
+    if isinstance(instruction, dict):
+        return dict_from_selectors(elt, instruction, path)
+    if isinstance(instruction, tuple):
+        return _profiled_tuple(elt, instruction, path)
+    step_path = _step_path(path, instruction)
+    return _profiler.measure(step_path, _apply_instruction, elt, instruction,
+                             step_path)
+
 
 def apply_tuple(elt, instruction):
     (selector, *rest) = instruction
@@ -32,7 +232,7 @@ def apply_tuple(elt, instruction):
     return apply_tuple(result, rest) if rest else result
 
 
-def apply_instruction(elt, instruction):
+def apply_instruction(elt, instruction, path=""):
     """A high level function that takes a bs4 Tag or document, followed by a
     directive that specifies the content to extract and the shape it should
     have.
@@ -73,7 +273,22 @@ def apply_instruction(elt, instruction):
         for each a.link tag, where the "text" key of each dict contains the
         text of the corresponding tag.
 
+    While `profiling()` is active, the time spent on each part of the
+    instruction is recorded under its `path` (see `Profiler`).
+
     """
+    if _profiler is not None:
+        if isinstance(instruction, (dict, tuple)):
+            return _profiler.measure(path or _label(instruction),
+                                     _profiled_step, elt, instruction, path)
+        path = path or _label(instruction)
+        return _profiler.measure(path, _apply_instruction, elt, instruction,
+                                 path)
+
+    return _apply_instruction(elt, instruction)
+
+
+def _apply_instruction(elt, instruction, path=""):
     if callable(instruction):
         return instruction(elt)
 
@@ -82,6 +297,11 @@ def apply_instruction(elt, instruction):
 
     if isinstance(instruction, list):
         instruction, *filters = instruction
+        if path:
+            # Profiling: filters are recorded below the selection's path
+            return [match for match in elt.select(instruction)
+                    if all(apply_instruction(match, filt, f"{path}?{i}")
+                           for i, filt in enumerate(filters, 1))]
         return [match for match in elt.select(instruction)
                 if all(apply_instruction(match, filt) for filt in filters)]
 
@@ -95,17 +315,23 @@ def apply_instruction(elt, instruction):
         return instruction.search(elt)
 
 
-def dict_from_selectors(elt: bs4.element.Tag, selectors: dict):
+def dict_from_selectors(elt: bs4.element.Tag, selectors: dict, path=""):
     """Generate a dictionary by specifying keys and the CSS selectors to
     retrieve information from the element.
 
     :param elt: the context for the CSS selectors
     :param selectors: a dictionary mapping output keys to instructions. The
     instructions can be strings (selectors), tuples of (selector, fns...)
+    :param path: the path of the dict within the enclosing instruction, used
+    when profiling
     """
     result = {}
     for prop, instruction in selectors.items():
-        applied = apply_instruction(elt, instruction)
+        if _profiler is not None:
+            applied = apply_instruction(elt, instruction,
+                                        f"{path}.{prop}" if path else prop)
+        else:
+            applied = apply_instruction(elt, instruction)
         if isinstance(applied, map):
             result[prop] = list(applied)
         elif isinstance(applied, bs4.Tag):
@@ -118,6 +344,136 @@ def dict_from_selectors(elt: bs4.element.Tag, selectors: dict):
 scrape = apply_instruction
 
 
+def compile(instruction, lazy=False):
+    """Compiles an instruction (see `apply_instruction`) into a plan: a function
+    that takes a bs4 Tag or document and returns the same result as
+    `apply_instruction` would. CSS selectors are parsed once, and the type of
+    each part of the instruction is only inspected at compile time, so
+    reusing a plan is much faster than interpreting the instruction again for
+    every element.
+
+        plan = compile((["a.link"], {"text": text}))
+        plan(doc)  # same as scrape(doc, (["a.link"], {"text": text}))
+
+    Plans are themselves valid instructions.
+
+    :param lazy: If True, list selections and the tuple chains applied to them
+    produce generators rather than lists, so that a consumer that stops early
+    (e.g., with `takewhile` or `islice`) skips the remaining work. Values in
+    dicts are still fully evaluated.
+
+    While `profiling()` is active, plans interpret their instruction instead,
+    so that each part of it is recorded. Lazy plans then return lists.
+    """
+    plan = _compile(instruction, lazy)
+    if callable(instruction):
+        return plan
+
+    def run_plan(elt):
+        if _profiler is not None:
+            return apply_instruction(elt, instruction)
+        return plan(elt)
+
+    return run_plan
+
+
+def _compile(instruction, lazy=False):
+    if callable(instruction):
+        return instruction
+
+    if isinstance(instruction, str):
+        return soupsieve.compile(instruction).select_one
+
+    if isinstance(instruction, list):
+        selector, *filters = instruction
+        compiled = soupsieve.compile(selector)
+        select = compiled.iselect if lazy else compiled.select
+        if not filters:
+            return select
+
+        filters = [_compile(filt) for filt in filters]
+        if lazy:
+            return lambda elt: (match for match in select(elt)
+                                if all(filt(match) for filt in filters))
+        return lambda elt: [match for match in select(elt)
+                            if all(filt(match) for filt in filters)]
+
+    if isinstance(instruction, dict):
+        return _compile_dict(instruction)
+
+    if isinstance(instruction, tuple):
+        if lazy:
+            return _compile_lazy_tuple(instruction)
+        return _compile_tuple(instruction)
+
+    return instruction.search
+
+
+def _compile_dict(selectors):
+    plans = [(prop, _compile(instruction))
+             for prop, instruction in selectors.items()]
+
+    def apply_dict(elt):
+        result = {}
+        for prop, plan in plans:
+            applied = plan(elt)
+            if isinstance(applied, map):
+                result[prop] = list(applied)
+            elif isinstance(applied, bs4.Tag):
+                result[prop] = applied.text.strip()
+            else:
+                result[prop] = applied
+        return result
+
+    return apply_dict
+
+
+def _compile_tuple(instruction):
+    plans = [_compile(step) for step in instruction]
+
+    def apply_steps(elt):
+        result = elt
+        for plan in plans:
+            if isinstance(result, list):
+                new_result = []
+                for member in result:
+                    add = plan(member)
+                    if isinstance(add, (list, map)):
+                        new_result += add
+                    else:
+                        new_result.append(add)
+                result = new_result
+            elif result:
+                result = plan(result)
+        return result
+
+    return apply_steps
+
+
+def _flat_map(plan, members):
+    for member in members:
+        add = plan(member)
+        if isinstance(add, (list, map, GeneratorType)):
+            yield from add
+        else:
+            yield add
+
+
+def _compile_lazy_tuple(instruction):
+    plans = [_compile(step, lazy=True) for step in instruction]
+
+    def apply_steps(elt):
+        result = elt
+        for plan in plans:
+            if isinstance(result, (list, GeneratorType)):
+                result = _flat_map(plan, result)
+            elif result:
+                result = plan(result)
+        return result
+
+    return apply_steps
+
+
 def text(elt):
     if isinstance(elt, bs4.Tag):
         return elt.text
@@ -148,23 +504,26 @@ def attr(attrname, val=None):
         else:
             return lambda elt: elt.attrs.get("attrname") == val
 
-    return lambda elt: elt.attrs.get(attrname, "")
+    return _named(lambda elt: elt.attrs.get(attrname, ""), f"attr({attrname})")
+
+
+DATES = DateParser()
 
 
 def date(arg=None, tz=None):
     if tz and not arg:
         if isinstance(tz, str):
             tz = pytz.timezone(tz)
-        return lambda x: date(x, tz)
+        return _named(lambda x: date(x, tz), "date")
 
     if isinstance(arg, bs4.Tag):
         arg = stripped_text(arg)
 
     if tz:
-        dt = dt_parse(arg, ignoretz=True)
+        dt = DATES.parse(arg, ignoretz=True)
         return tz.localize(dt)
 
-    return dt_parse(arg)
+    return DATES.parse(arg)
 
 
 def text_contains(arg):
@@ -187,7 +546,9 @@ def either(*fns):
 
 def ch(*fns):
     "Chain together some functions."
-    return lambda elt: reduce((lambda x, fn: apply_instruction(x, fn)), fns, elt)
+    plans = [_compile(fn) for fn in fns]
+    return _named(lambda elt: reduce((lambda x, plan: plan(x)), plans, elt),
+                  "ch({})".format(", ".join(_label(fn) for fn in fns)))
 
 
 def to_under(s):
@@ -200,7 +561,14 @@ def col_names(table):
     return [th.get_text().strip() for th in tr.find_all("th")]
 
 
-def tabular(field_processors={}, convert_column=to_under, index=None):
+def tabular(field_processors={}, convert_column=to_under, index=None,
+            lazy=False):
+    """Returns a function that scrapes a table into a list of dicts, one per row,
+    keyed by column name. With `index`, returns a dict of the rows keyed by
+    the value of that column instead. With `lazy`, returns a generator of the
+    rows, which are only processed as they are consumed.
+
+    """
     def process_table(elt):
         table = elt if elt.name == "table" else elt.find("table")
         columns = [convert_column(c) for c in col_names(table)]
@@ -211,6 +579,8 @@ def tabular(field_processors={}, convert_column=to_under, index=None):
                 for row in rows)
         if index:
             return {datum[index]: datum for datum in data}
+        elif lazy:
+            return data
         else:
             return list(data)
 
@@ -220,25 +590,102 @@ def tabular(field_processors={}, convert_column=to_under, index=None):
     return process_table
 
 
-def address(text=None, defaults={}):
-    if not text and defaults:
-        return lambda elt: address(elt, defaults)
+class LRUCache(object):
+    """A thread-safe, bounded cache that discards the least recently used values
+    first and counts hits and misses. Caches kept at module level survive
+    across warm Lambda invocations.
+
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        "Returns the cached value for `key`, calling `compute()` on a miss."
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+
+        value = compute()
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._data), "maxsize": self.maxsize,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def memoize(cache):
+    """Decorator that caches a function's return values in `cache`, which may be
+    shared by several functions. Arguments must be hashable, and return values
+    should be immutable.
+
+    """
+    def decorator(fn):
+        name = f"{fn.__module__}.{fn.__qualname__}"
+
+        @wraps(fn)
+        def wrapped(*args):
+            return cache.get((name, args), lambda: fn(*args))
+
+        wrapped.cache = cache
+        return wrapped
+
+    return decorator
 
-    if isinstance(text, bs4.Tag):
-        text = text.text
 
+# Shared by the address parsers of all scrapers.
+ADDRESS_CACHE = LRUCache(int(os.environ.get("ADDRESS_CACHE_SIZE", "2048")))
+
+
+@memoize(ADDRESS_CACHE)
+def parse_address(text):
+    """Tags an address with usaddress and normalizes it.
+
+    :returns: a tuple of (name, city, state, zip). Components that were not
+    found are None.
+
+    """
     tagged, _ = usaddress.tag(text)
     tagged = defaultdict(str, tagged)
-    street_address = "{AddressNumber} {StreetName} {StreetNamePostType}".format(**tagged)
     occupancy = "{a[Recipient]}\n{a[OccupancyIdentifier]} {a[OccupancyType]}".format(a=tagged)
     place = tagged["Place"]
     if "\n" in place:
         occupancy_name, place = place.rsplit("\n", 1)
         occupancy += f" {occupancy_name}"
     occupancy = re.sub(r"(^\s+|(?<=\s)\s+|\s+$)", "", occupancy)
+    return (occupancy, place or None, tagged.get("Statename"),
+            tagged.get("ZipCode"))
+
+
+def address(text=None, defaults={}):
+    if not text and defaults:
+        return _named(lambda elt: address(elt, defaults), "address")
+
+    if isinstance(text, bs4.Tag):
+        text = text.text
+
+    name, city, state, zip_code = parse_address(text)
     return {
-        "name": occupancy,
-        "city": place or defaults["city"],
-        "state": tagged.get("Statename", defaults["state"]),
-        "zip": tagged.get("ZipCode", defaults["zip"])
+        "name": name,
+        "city": city or defaults["city"],
+        "state": defaults["state"] if state is None else state,
+        "zip": defaults["zip"] if zip_code is None else zip_code
     }
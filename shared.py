@@ -1,13 +1,21 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, tzinfo
 
 import pytz
 
 
-def preprocess(timezone, default_period=timedelta(days=30)):
+def preprocess(timezone, default_period=timedelta(days=30), params=()):
     """Decorator that returns a function that takes a Request-like object with a
     'since' parameter of the form YYYYmmdd and calls the wrapped function with
     a datetime.
 
+    If 'since' is omitted, the wrapped function is called with the current
+    time minus `default_period`, or with None if `default_period` is None.
+
+    The values of any request parameters named in `params` are passed to the
+    wrapped function as keyword arguments.
+
     """
     if not isinstance(timezone, tzinfo):
         timezone = pytz.timezone(timezone)
@@ -17,13 +25,48 @@ def preprocess(timezone, default_period=timedelta(days=30)):
             since = req["since"]
             if since:
                 since = timezone.localize(datetime.strptime(since, "%Y%m%d"))
-            else:
+            elif default_period is not None:
                 now = pytz.utc.localize(datetime.utcnow()).astimezone(timezone)
                 since = now - default_period
+            else:
+                since = None
 
-            return view_fn(since)
+            return view_fn(since, **{param: req[param] for param in params})
 
         wrapped.__name__ = view_fn.__name__
         return wrapped
 
     return wrapper_fn
+
+
+def truthy(param):
+    "Interprets a request parameter as a flag: present and not '0' or 'false'."
+    return bool(param) and param.lower() not in ("0", "false")
+
+
+def ordered_map(fn, iterable, workers=4):
+    """Like `map`, but calls `fn` on up to `workers` items concurrently in a
+    thread pool. Results are yielded in the order of `iterable`, and at most
+    `workers` items are submitted ahead of the consumer, so a consumer that
+    stops early (e.g., with `takewhile`) does not trigger much wasted work.
+
+    With `workers` less than 2, this is equivalent to `map`.
+
+    """
+    if not workers or workers < 2:
+        yield from map(fn, iterable)
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in iterable:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= workers:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
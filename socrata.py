@@ -1,7 +1,10 @@
 from urllib import parse
-from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from urllib.request import Request
 import json
 
+import http_cache
+
 
 accepts = {
     "json": "application/json",
@@ -27,6 +30,10 @@ def make_request(domain, resource_id, token, soql=None, where=None,
 
 def json_request(*args, **kwargs):
     req = make_request(*args, **kwargs)
-    with urlopen(req) as f:
-        return json.loads(f.read().decode("utf-8"))
+    response = http_cache.fetch(req.full_url, dict(req.header_items()))
+    if response.status_code != 200:
+        raise HTTPError(req.full_url, response.status_code,
+                        f"Socrata request failed: {response.status_code}",
+                        response.headers, None)
+    return json.loads(response.content.decode("utf-8"))
 
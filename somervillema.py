@@ -3,14 +3,17 @@ import logging
 import re
 import os
 from functools import partial
-from bs4 import BeautifulSoup
-from itertools import takewhile
+from itertools import dropwhile
 
+from bs4 import SoupStrainer
 import pytz
-import requests
 
+from changes import fingerprint, Snapshot
 from cloud import aws_lambda
-from shared import preprocess
+import http_cache
+from scrape_utils import ADDRESS_CACHE, make_soup, memoize
+from shared import ordered_map, preprocess, truthy
+from watermark import Watermark
 
 from urllib.error import HTTPError, URLError
 from urllib.parse import urljoin
@@ -23,6 +26,9 @@ URL_BASE = (f"{URL_HOST}/departments/ospcd/"
             "planning-and-zoning/reports-and-decisions/robots")
 URL_FORMAT = URL_BASE + "?page={:1}"
 REGION_NAME = "Somerville, MA"
+REGION_ID = "somervillema"
+# Number of concurrent requests to use when fetching result pages:
+FETCH_WORKERS = int(os.environ.get("SOMERVILLEMA_FETCH_WORKERS", "4"))
 
 def to_under(s):
     "Converts a whitespace-separated string to underscore-separated."
@@ -165,12 +171,19 @@ def attribute_for_title(title):
     return TITLES.get(title, to_under(title))
 
 
-# TODO: Return None or error if the response is not successful
 def get_page(page=1, url_format=URL_FORMAT):
-    "Returns the HTML content of the given Reports and Decisions page."
-    response = requests.get(url_format.format(page))
-    if response.status_code == 200:
-        return response.content
+    """Returns the HTML content of the given Reports and Decisions page. Raises
+    HTTPError if the page could not be retrieved.
+
+    """
+    url = url_format.format(page)
+    response = http_cache.fetch(url)
+    if response.status_code != 200:
+        raise HTTPError(url, response.status_code,
+                        f"Reports and Decisions request failed: "
+                        f"{response.status_code}",
+                        response.headers, None)
+    return response.content
 
 
 def detect_last_page(doc):
@@ -220,20 +233,33 @@ def get_td_val(td, attr=None):
     return processor(td)
 
 
-def parse_addresses(number, street):
-    number_sublists = re.split(r"\s*/\s*", number)
-    street_sublists = re.split(r"\s*/\s*", street)
+ADDRESS_SEPARATOR = re.compile(r"\s*/\s*")
+NUMBER_RANGE = re.compile(r"(\d+)-(\d+)")
+NUMBER_SEPARATOR = re.compile(r",? and |,? & |, ")
+
+
+@memoize(ADDRESS_CACHE)
+def split_addresses(number, street):
+    "Returns a tuple of the (number, street) pairs in an address."
+    pairs = []
+    number_sublists = ADDRESS_SEPARATOR.split(number)
+    street_sublists = ADDRESS_SEPARATOR.split(street)
 
     for number, street in zip(number_sublists, street_sublists):
-        number_range_match = re.match(r"(\d+)-(\d+)", number)
+        number_range_match = NUMBER_RANGE.match(number)
 
         if number_range_match:
-            yield (number_range_match.group(1), street)
-            yield (number_range_match.group(2), street)
+            pairs.append((number_range_match.group(1), street))
+            pairs.append((number_range_match.group(2), street))
         else:
-            number_sublist = re.split(r",? and |,? & |, ", number)
-            for number in number_sublist:
-                yield (number, street)
+            for number in NUMBER_SEPARATOR.split(number):
+                pairs.append((number, street))
+
+    return tuple(pairs)
+
+
+def parse_addresses(number, street):
+    yield from split_addresses(number, street)
 
 
 def get_address_list(number, street):
@@ -288,6 +314,7 @@ def find_cases(doc):
             proposal["events"] = events
             del proposal["number"]
             del proposal["street"]
+            proposal["fingerprint"] = fingerprint(proposal)
 
             cases.append(proposal)
         except Exception as err:
@@ -297,47 +324,115 @@ def find_cases(doc):
     return cases
 
 
-def get_proposals_for_page(page):
+# Scraping a results page only requires the case table and the pager, so by
+# default, the rest of the document (navigation, footer, scripts) is skipped
+# during parsing.
+PAGE_STRAINER = SoupStrainer(
+    ["table", "li"],
+    attrs={"class": re.compile(r"(^|\s)(views-table|pager-last)(\s|$)")})
+PARTIAL_PARSE = os.environ.get("SOMERVILLEMA_PARTIAL_PARSE", "1") != "0"
+
+
+def parse_page(html, partial_parse=PARTIAL_PARSE):
+    return make_soup(html,
+                     parse_only=PAGE_STRAINER if partial_parse else None)
+
+
+def get_proposals_for_page(page, partial_parse=PARTIAL_PARSE):
     html = get_page(page)
-    doc = BeautifulSoup(html, "html.parser")
+    doc = parse_page(html, partial_parse)
     logger.info("Scraping page {num}".format(num=page))
     cases = find_cases(doc)
 
     return cases
 
 
-def get_pages():
-    """Returns a generator that retrieves Reports and Decisions pages and
-    parses them as HTML.
+def get_doc(page, partial_parse=PARTIAL_PARSE):
+    """Retrieves and parses the given Reports and Decisions page. Errors are
+    logged and raised, so that a failed fetch is not mistaken for the end of
+    the results.
+
+    :param partial_parse: If True, only parse the case table and the pager
 
     """
-    i = 0
-    last_page = None
+    try:
+        html = get_page(page)
+    except (HTTPError, URLError) as err:
+        logger.warning("Failed to retrieve page %d: %s", page, err)
+        raise
 
-    while True:
-        try:
-            # There's currently a bug in the Reports and Decisions page
-            # that causes nonexistent pages to load page 1. They should
-            # return a 404 error instead!
-            html = get_page(i)
-        except HTTPError as err:
-            break
+    return parse_page(html, partial_parse)
 
-        except URLError as err:
-            logger.warn("Failed to retrieve URL for page %d.", i,
-                        err)
-            break
 
-        doc = BeautifulSoup(html, "html.parser")
-        if last_page is None:
-            last_page = detect_last_page(doc)
+def seek_page(until, last_page, get_doc, date_column="updated_date",
+              docs=None):
+    """Performs a binary search over the results pages, which are sorted by
+    `date_column` in descending order, for the first page that contains a
+    case with a `date_column` value at or before `until`.
 
-        yield doc
+    :param get_doc: a function that takes a page number and returns the
+    parsed page
 
-        i += 1
+    :param docs: a dict mapping page numbers to documents already retrieved,
+    which are reused. Documents retrieved during the search are added to it.
 
-        if i > last_page:
-            break
+    :returns: a tuple of the page number and a dict mapping page numbers to
+    the documents retrieved
+
+    """
+    docs = {} if docs is None else docs
+    lo, hi = 0, last_page
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mid not in docs:
+            docs[mid] = get_doc(mid)
+        doc = docs[mid]
+        cases = find_cases(doc)
+        if not cases:
+            hi = mid
+        elif cases[0][date_column] <= until:
+            hi = mid
+        elif cases[-1][date_column] > until:
+            lo = mid + 1
+        else:
+            return mid, docs
+
+    return lo, docs
+
+
+def get_pages(workers=FETCH_WORKERS, partial_parse=PARTIAL_PARSE, until=None,
+              date_column="updated_date"):
+    """Returns a generator that retrieves Reports and Decisions pages and
+    parses them as HTML.
+
+    :param workers: Once the last page is known, fetch the remaining pages
+    using up to this many concurrent requests. The pages are still produced in
+    order. Set to 1 to fetch the pages serially.
+
+    :param partial_parse: If True, only parse the case table and the pager
+
+    :param until: If provided, skip the leading pages whose cases were all
+    updated after this datetime, using a binary search over page numbers.
+
+    """
+    # There's currently a bug in the Reports and Decisions page that causes
+    # nonexistent pages to load page 1. They should return a 404 error
+    # instead! Only request pages up to the last page listed in the pager.
+    doc = get_doc(0, partial_parse)
+    last_page = detect_last_page(doc)
+    fetch = lambda page: get_doc(page, partial_parse)
+    start, fetched = 0, {0: doc}
+    if until:
+        start, _ = seek_page(until, last_page, fetch, date_column, fetched)
+        logger.info("Seeking to page %d of %d", start, last_page)
+
+    # Produce the first page before fetching any more, so that a consumer
+    # that stops on the first page (e.g., a steady-state incremental run)
+    # only fetches that page.
+    yield fetched.pop(start, None) or fetch(start)
+
+    yield from ordered_map(lambda page: fetched.pop(page, None) or fetch(page),
+                           range(start + 1, last_page + 1), workers)
 
 
 def get_cases(gen=None):
@@ -346,10 +441,12 @@ def get_cases(gen=None):
         yield from find_cases(doc)
 
 
-def get_proposals_since(dt=None,
-                        stop_at_case=None,
-                        date_column="updated_date",):
-    """Page through the Reports and Decisions page, scraping the proposals
+def iter_proposals_since(dt=None,
+                         stop_at_case=None,
+                         date_column="updated_date",
+                         watermark=None,
+                         until=None):
+    """Page through the Reports and Decisions page, generating the proposals
     until the submission date is less than or equal to the given date.
 
     :param dt: If provided, stop scraping when the `date_column` is less
@@ -360,25 +457,116 @@ def get_proposals_since(dt=None,
 
     :param date_column: Customize the name of the date column
 
-    :returns: A list of dicts representing scraped cases.
+    :param watermark: If provided, a `Watermark`. Stop scraping at the first
+    case that the watermark has already seen, then advance and save it. The
+    watermark is only saved once the scan has reached a case outside the
+    window or the last page. If a page cannot be retrieved, the error is
+    raised and the saved watermark is left as it was, so that the cases on
+    the remaining pages are returned by the next run.
+
+    :param until: If provided, only return cases where `date_column` is at or
+    before this datetime. Pages entirely after `until` are skipped using a
+    binary search, so only the pages covering the window are scraped.
+
+    If none of `dt`, `stop_at_case` or a saved `watermark` is provided,
+    scrape the cases updated in the last 7 days.
+
+    :returns: A generator of dicts representing scraped cases.
 
     """
-    if not dt:
+    if not (dt or stop_at_case or (watermark and watermark.timestamp)):
         dt = datetime.now() - timedelta(days=7)
-    if not dt.tzinfo:
+    if dt and not dt.tzinfo:
         dt = TIMEZONE.localize(dt)
+    if until and not until.tzinfo:
+        until = TIMEZONE.localize(until)
 
+    guards = []
     if dt:
-        guard = lambda case: case[date_column] > dt
-    elif stop_at_case:
-        guard = lambda case: case["case_number"] != stop_at_case
+        guards.append(lambda case: case[date_column] > dt)
+    if stop_at_case:
+        guards.append(lambda case: case["case_number"] != stop_at_case)
+    if watermark:
+        # Compare against the watermark as loaded, since `watermark` itself
+        # advances past the cases as they are generated.
+        seen_before = Watermark(watermark.region, watermark.store,
+                                watermark.timestamp, watermark.seen)
+        guards.append(lambda case: not seen_before.has_seen(case, date_column))
+
+    guard = lambda case: all(g(case) for g in guards)
+    cases = get_cases(get_pages(until=until, date_column=date_column))
+    if until:
+        cases = dropwhile(lambda case: case[date_column] > until, cases)
+    for case in cases:
+        if not guard(case):
+            break
+        if watermark:
+            watermark.advance([case], date_column)
+        yield case
+
+    # Reached the window boundary or the end of the results. get_pages raises
+    # if a page could not be fetched, so a partial scan never gets here.
+    if watermark:
+        watermark.save()
+
+
+def get_proposals_since(*args, **kwargs):
+    """Returns a list of the proposals generated by `iter_proposals_since`, which
+    takes the same arguments.
+
+    """
+    return list(iter_proposals_since(*args, **kwargs))
 
-    all_cases = list(takewhile(guard, get_cases()))
 
-    return all_cases
+def get_changed_proposals(cases, window_start=None):
+    """Filters `cases`, generating only those that are new or have changed since
+    the last call, plus tombstones for cases that have disappeared from the
+    window starting at `window_start`. The snapshot is only saved once
+    `cases` has been exhausted, so a scan that fails partway through produces
+    no tombstones and leaves the snapshot unchanged.
+
+    """
+    snapshot = Snapshot.load(REGION_ID)
+    for case in snapshot.changes(cases, window_start):
+        case.setdefault("region_name", REGION_NAME)
+        yield case
+    snapshot.save()
+
+
+# The window scraped when a request has no `since` parameter
+DEFAULT_PERIOD = timedelta(days=30)
 
 
 @aws_lambda
-@preprocess(TIMEZONE)
-def scrape(since):
-    return {"cases": get_proposals_since(since)}
+@preprocess(TIMEZONE, default_period=None,
+            params=("incremental", "changed_only"))
+def scrape(since, incremental=None, changed_only=None):
+    """Returns the cases updated since `since`, or in the last 30 days.
+
+    With an `incremental` parameter and no `since`, returns the cases updated
+    since the last incremental request instead (or in the last 30 days, the
+    first time). The watermark is saved once every case has been generated,
+    so a client that fails to receive a response will not see those cases
+    again; clients that cannot tolerate that should pass `since`.
+
+    With a `changed_only` parameter, only return cases that have changed since
+    the last request that included it.
+
+    """
+    window_start = since or datetime.now(TIMEZONE) - DEFAULT_PERIOD
+    if since or not truthy(incremental):
+        cases = iter_proposals_since(window_start)
+    else:
+        watermark = Watermark.load(REGION_ID)
+        if watermark.timestamp:
+            window_start = datetime.fromtimestamp(watermark.timestamp, TIMEZONE)
+            cases = iter_proposals_since(watermark=watermark)
+        else:
+            cases = iter_proposals_since(window_start, watermark=watermark)
+
+    if truthy(changed_only):
+        # Cases in the snapshot updated within the scanned window that are no
+        # longer listed have disappeared.
+        cases = get_changed_proposals(cases, window_start)
+
+    return {"cases": cases}
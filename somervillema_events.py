@@ -1,38 +1,85 @@
 from datetime import datetime, timedelta
-import io
-from itertools import takewhile
+from functools import lru_cache, partial
+import hashlib
+from itertools import islice, takewhile
+import logging
 import os
 import re
+import tempfile
+import threading
 from urllib import parse
+from urllib.error import HTTPError
 
 from cloud import aws_lambda
-from scrape_utils import (attr, ch, scrape,
+from extractors.utils import has_pdftotext, pdf_pages
+import http_cache
+import http_client
+from scrape_utils import (attr, ch, compile, make_soup,
                           address, date, text, text_children, text_contains)
-from shared import preprocess
+from shared import ordered_map, preprocess
+import stores
 
-import bs4
 import pytz
 import requests
 
 from PyPDF2 import PdfFileReader
 
+logger = logging.getLogger(__name__)
+
 URL = "https://www.somervillema.gov/event-documents"
 TIMEZONE = pytz.timezone("US/Eastern")
 
+# The number of events whose detail pages and agendas are fetched concurrently
+FETCH_WORKERS = int(os.environ.get("SOMERVILLEMA_EVENTS_FETCH_WORKERS", "4"))
+# The most Event Documents pages to fetch in one run
+MAX_PAGES = int(os.environ.get("SOMERVILLEMA_EVENTS_MAX_PAGES", "50"))
+# The maximum total size of the cached agenda case numbers
+AGENDA_CACHE_MAX_BYTES = int(os.environ.get("AGENDA_CACHE_MAX_BYTES",
+                                            str(4*1024*1024)))
+# The most pages of each agenda to search for case numbers, or 0 for all
+AGENDA_MAX_PAGES = int(os.environ.get("SOMERVILLEMA_EVENTS_AGENDA_PAGES", "0"))
+
 
 def file_name(url):
     return os.path.basename(parse.urlsplit(url).path)
 
 
 # PDF Scraping
-CasePattern = r"\s?((?:[\dA-Z]+-)+(?:[\dA-Z]+))"
-PBCasePattern = r"(PB)" + CasePattern
-ZBACasePattern = r"(ZBA)" + CasePattern
+# A year followed by dash-separated parts, e.g., "2020-06" or "2019-136-R1".
+# A part may continue on the next line after a hyphen.
+CasePattern = r"[\s#]*((?:\d{4}|\d\d)(?:-\s*[A-Z]?\d+)+)\b"
+PBCasePattern = r"\b(PB)" + CasePattern
+ZBACasePattern = r"\b(ZBA)" + CasePattern
 
 
-def get_pdf(url):
-    pdf_in = io.BytesIO(requests.get(url).content)
-    return PdfFileReader(pdf_in)
+def download_pdf(url, outfile):
+    """Streams the document at `url` to the file object `outfile`.
+
+    :returns: the SHA-1 hex digest of the document
+    """
+    digest = hashlib.sha1()
+    with http_client.get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(64*1024):
+            digest.update(chunk)
+            outfile.write(chunk)
+    outfile.flush()
+    return digest.hexdigest()
+
+
+def pdf_page_texts(pdf_path, max_pages=AGENDA_MAX_PAGES):
+    """Generates the text of each of the first `max_pages` pages (or all pages,
+    if 0) of a local PDF, page by page. Uses poppler's pdftotext, which is much
+    faster than PyPDF2, when it is installed.
+
+    """
+    if has_pdftotext():
+        yield from pdf_pages(pdf_path, last_page=max_pages or None)
+        return
+
+    with open(pdf_path, "rb") as infile:
+        for page in islice(PdfFileReader(infile).pages, max_pages or None):
+            yield page.extractText()
 
 
 def case_year(case):
@@ -41,51 +88,223 @@ def case_year(case):
     return int(year) if year and year.isdigit() else 0
 
 
-def get_cases(pdf, case_pattern=PBCasePattern):
+def get_cases(pdf, case_pattern=PBCasePattern, max_pages=AGENDA_MAX_PAGES):
     """Extremely crude approach to scraping cases from an agenda PDF.
+
+    :param pdf: a PdfFileReader, or the path or URL of a PDF
+    """
+    if isinstance(pdf, PdfFileReader):
+        pages = (page.extractText()
+                 for page in islice(pdf.pages, max_pages or None))
+    elif parse.urlsplit(pdf).scheme in ("http", "https"):
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            download_pdf(pdf, pdf_file)
+            yield from get_cases(pdf_file.name, case_pattern, max_pages)
+        return
+    else:
+        pages = pdf_page_texts(pdf, max_pages)
+
+    for page_text in pages:
+        # Keep line breaks as whitespace, so that a case number at the end of
+        # a line is not joined to the start of the next.
+        matches = re.findall(case_pattern, page_text.replace("\n", " "))
+        for auth, case in matches:
+            yield "{} {}".format(auth, re.sub(r"\s+", "", case))
+
+
+# Case numbers extracted from agendas are cached in the store configured by
+# AGENDA_CACHE_DIR or AGENDA_CACHE_BUCKET (see `stores.store_from_env`), keyed
+# by the agenda's URL and ETag, or by a hash of its contents when the server
+# does not identify versions. The cache is an optimization only: if it cannot
+# be used, agendas are downloaded and parsed as if it were empty.
+_agenda_store = None
+_agenda_store_lock = threading.Lock()
+
+
+def agenda_store():
+    """Returns the shared agenda cache store, creating it if necessary, or None
+    if it could not be created.
+
+    """
+    global _agenda_store
+
+    with _agenda_store_lock:
+        if _agenda_store is None:
+            try:
+                _agenda_store = stores.store_from_env("AGENDA_CACHE")
+            except Exception as err:
+                logger.warning("Failed to create the agenda cache: %s", err)
+
+    return _agenda_store
+
+
+def evict_agendas(store=None):
+    store = store or agenda_store()
+    if not store:
+        return
+
+    try:
+        stores.evict(store, max_bytes=AGENDA_CACHE_MAX_BYTES)
+    except Exception as err:
+        logger.warning("Failed to evict agenda cache entries: %s", err)
+
+
+def load_agenda_cases(store, key):
+    "Returns the cached case numbers for `key`, or None on a miss or error."
+    if not (store and key):
+        return None
+
+    try:
+        return stores.get_json(store, key)
+    except Exception as err:
+        logger.warning("Failed to read agenda cache entry %s: %s", key, err)
+        return None
+
+
+def save_agenda_cases(store, key, cases):
+    if not store:
+        return
+
+    try:
+        stores.put_json(store, key, cases)
+    except Exception as err:
+        logger.warning("Failed to cache agenda entry %s: %s", key, err)
+
+
+def agenda_key(*parts):
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest() + ".json"
+
+
+def agenda_version(url):
+    """Returns a string that changes whenever the document at `url` does, based
+    on its ETag, or on its Last-Modified and Content-Length headers. Returns
+    None if the server does not provide them.
+
     """
-    if isinstance(pdf, str):
-        pdf = get_pdf(pdf)
+    try:
+        response = http_client.head(url, allow_redirects=True)
+    except requests.RequestException:
+        return None
+
+    headers = response.headers
+    if response.status_code != 200:
+        return None
+    if headers.get("ETag"):
+        return headers["ETag"]
+    if headers.get("Last-Modified"):
+        return f"{headers['Last-Modified']} {headers.get('Content-Length', '')}"
+
+
+def get_agenda_cases(url, case_pattern=PBCasePattern, store=None):
+    """Returns the case numbers in the agenda PDF at `url`, skipping the
+    download if the agenda has not changed since it was last seen, and the
+    parse if its contents are the same as an agenda already parsed. Errors
+    reading or writing the cache are logged and otherwise ignored.
 
-    for page in pdf.pages:
-        matches = re.findall(case_pattern, page.extractText().replace("\n", ""))
-        yield from [f"{auth} {case}" for auth, case in matches]
+    """
+    store = store or agenda_store()
+    pages = str(AGENDA_MAX_PAGES)
+    version = agenda_version(url)
+    key = version and agenda_key(url, case_pattern, pages, version)
+    cases = load_agenda_cases(store, key)
+    if cases is not None:
+        return cases
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+        digest = download_pdf(url, pdf_file)
+        if not key:
+            key = agenda_key(case_pattern, pages, digest)
+            cases = load_agenda_cases(store, key)
+            if cases is not None:
+                return cases
+
+        cases = list(get_cases(pdf_file.name, case_pattern))
+    save_agenda_cases(store, key, cases)
+    return cases
 
 
 # Web scraping
 def get_page(url):
-    return bs4.BeautifulSoup(requests.get(url).content, "html.parser")
+    "Fetches and parses the page at `url`. Raises HTTPError on failure."
+    response = http_cache.fetch(url)
+    if response.status_code != 200:
+        raise HTTPError(url, response.status_code,
+                        f"Somerville events request failed: "
+                        f"{response.status_code}",
+                        response.headers, None)
+    return make_soup(response.content)
+
+
+ADDRESS_DEFAULTS = {"city": "Somerville", "state": "MA", "zip": "02143"}
+EVENT_DETAILS_SPEC = {
+    "location": (".calendar-content__event-location", ch(text_children, "\n".join,
+                                                         address(defaults=ADDRESS_DEFAULTS))),
+    "description": (".main-content .field-type-text-with-summary", ch(["p"], text, "\n".join)),
+    "departments": ([".field-name-field-event-department li"], text),
+    "contact": (".field-name-field-event-contact-name", [".field-items .field-item"], text),
+    "image": (".field-content a img", attr("src")),
+    "cost": ".calendar-content__price",
+    "accessibility": ".calendar-content__accessibility-text"
+}
+EVENT_DETAILS = compile(EVENT_DETAILS_SPEC)
 
 
 def get_event_details(event):
-    address_defaults = {"city": "Somerville", "state": "MA", "zip": "02143"}
-    details =  scrape(event, {
-        "location": (".calendar-content__event-location", ch(text_children, "\n".join,
-                                                             address(defaults=address_defaults))),
-        "description": (".main-content .field-type-text-with-summary", ch(["p"], text, "\n".join)),
-        "departments": ([".field-name-field-event-department li"], text),
-        "contact": (".field-name-field-event-contact-name", [".field-items .field-item"], text),
-        "image": (".field-content a img", attr("src")),
-        "cost": ".calendar-content__price",
-        "accessibility": ".calendar-content__accessibility-text"
-    })
-    return details
+    return EVENT_DETAILS(event)
 
 
 def url_for_page(i):
     return f"{URL}?page={i}"
 
 
-def get_pages(make_url=url_for_page):
-    """Lazily grabs event pages from the Somerville events site. Consumers should
-    also be lazily evaluated, or else have some terminating condition;
-    otherwise, this will bombard somervillema.gov with requests.
+EVENT_ROWS = ".view-event-documents tbody tr"
+
+
+def detect_last_page(doc):
+    """Returns the index of the last page linked from the pager, or None if
+    there is no link (e.g., on the last page itself).
 
     """
-    yield from ((url, get_page(url)) for url in map(make_url, range(50)))
+    anchor = doc.select_one("li.pager-last a")
+    m = anchor and re.search(r"[?&]page=(\d+)", anchor.get("href", ""))
+    return int(m.group(1)) if m else None
+
 
+def get_pages(make_url=url_for_page, max_pages=MAX_PAGES):
+    """Lazily grabs event pages from the Somerville events site, stopping after
+    the last page listed in the pager, at the first page with no events or
+    that repeats an earlier page, or after `max_pages` pages. A page that
+    cannot be retrieved raises HTTPError rather than ending the crawl.
 
-def get_events(doc, url_base=URL, match=r"Planning Board|Zoning Board of Appeals"):
+    """
+    last_page = None
+    seen = set()
+    for i in range(max_pages):
+        if last_page is not None and i > last_page:
+            return
+
+        url = make_url(i)
+        doc = get_page(url)
+        rows = tuple(row.get_text() for row in doc.select(EVENT_ROWS))
+        if not rows:
+            return
+        if rows in seen:
+            # Like the Reports and Decisions pages, nonexistent pages may
+            # load the first page again.
+            logger.warning("%s repeats an earlier page; stopping", url)
+            return
+        seen.add(rows)
+
+        found = detect_last_page(doc)
+        if found is not None:
+            last_page = found
+        yield url, doc
+
+
+EVENT_MATCH = r"Planning Board|Zoning Board of Appeals"
+
+
+def events_spec(url_base=URL, match=EVENT_MATCH):
     def make_absolute(url):
         return parse.urljoin(url_base, url)
 
@@ -94,18 +313,36 @@ def get_events(doc, url_base=URL, match=r"Planning Board|Zoning Board of Appeals
 
     match = re.compile(match)
 
-    return scrape(doc,
-                  ([".view-event-documents tbody tr", (".views-field-field-event-doc-event", text, match)],
-                   {"title": (".views-field-field-event-doc-event", text, str.strip),
-                    "url": (".views-field-field-event-doc-event a", attr("href"), make_absolute),
-                    "start": (".date-display-single", attr("content"), date(tz=TIMEZONE)),
-                    "documents": (["span.file a"], {"url": (attr("href"), make_absolute),
-                                                    "file_title": (attr("href"), file_name),
-                                                    "title": (text, remove_prefix)})
-                   }))
+    return ([EVENT_ROWS, (".views-field-field-event-doc-event", text, match)],
+            {"title": (".views-field-field-event-doc-event", text, str.strip),
+             "url": (".views-field-field-event-doc-event a", attr("href"), make_absolute),
+             "start": (".date-display-single", attr("content"), date(tz=TIMEZONE)),
+             "documents": (["span.file a"], {"url": (attr("href"), make_absolute),
+                                             "file_title": (attr("href"), file_name),
+                                             "title": (text, remove_prefix)})
+            })
+
+
+@lru_cache(maxsize=16)
+def events_plan(url_base=URL, match=EVENT_MATCH, lazy=False):
+    return compile(events_spec(url_base, match), lazy=lazy)
+
+
+def get_events(doc, url_base=URL, match=EVENT_MATCH, lazy=False):
+    """Scrapes the events from an Event Documents page. With `lazy`, returns a
+    generator that scrapes each row as it is consumed.
+
+    :param url_base: the URL of the page, against which links are resolved.
+    The listing pages differ only in their query strings, which do not affect
+    the event and document links, so the query is dropped and all the pages
+    share one compiled plan.
+
+    """
+    url_base = parse.urlsplit(url_base)._replace(query="", fragment="").geturl()
+    return events_plan(url_base, match, lazy)(doc)
 
 
-def add_event_details(event):
+def add_event_details(event, store=None):
     details = get_event_details(get_page(event["url"]))
     year = event["start"].year
     event.update(details)
@@ -115,7 +352,8 @@ def add_event_details(event):
     for doc in event["documents"]:
         if "Agenda" in doc["title"]:
             pattern = PBCasePattern if dept == "pb" else ZBACasePattern
-            event["cases"] = [cn for cn in get_cases(doc["url"], pattern)
+            event["cases"] = [cn for cn
+                              in get_agenda_cases(doc["url"], pattern, store)
                               if year - case_year(cn) <= 4]  # hack!
             break
 
@@ -123,30 +361,56 @@ def add_event_details(event):
     return event
 
 
-def get_page_events(url, page):
-    return map(add_event_details, get_events(page, url))
+def add_all_event_details(events, workers=FETCH_WORKERS):
+    """Fetches the details and agendas of `events`, up to `workers` at a time,
+    generating the events in order. Once all the events have been generated,
+    the agenda cache is trimmed to its maximum size.
+
+    """
+    store = agenda_store()
+    yield from ordered_map(partial(add_event_details, store=store), events,
+                           workers)
+    evict_agendas(store)
 
 
-def get_all_events():
+def get_page_events(url, page, workers=FETCH_WORKERS):
+    return add_all_event_details(get_events(page, url, lazy=True), workers)
+
+
+def get_listed_events():
+    "Generates the events listed on the Event Documents pages, without details."
+    for url, page in get_pages():
+        yield from get_events(page, url, lazy=True)
+
+
+def get_all_events(workers=FETCH_WORKERS):
     """Generates event details by pulling in the city's Event Documents pages one
     by one, scraping each for a list of events, then scraping the attached
     agenda documents. This is meant to be consumed lazily and only as needed,
     since it will keep working until the consumer stops requesting more events
     or an Exception occurs.
 
+    The details and agendas of up to `workers` upcoming events are fetched
+    concurrently, across page boundaries, but events are generated in order.
+
     """
-    for url, page in get_pages():
-        yield from get_page_events(url, page)
+    yield from add_all_event_details(get_listed_events(), workers)
+
 
+def get_events_since(when: datetime, workers=FETCH_WORKERS):
+    """Generates the events that start after `when`. Events are filtered on the
+    fields scraped from the listing before their details are fetched, so the
+    event that ends the scan is never enriched.
 
-def get_events_since(when: datetime):
+    """
     if not when.tzinfo:
         when = TIMEZONE.localize(when)
 
-    yield from takewhile(lambda event: event["start"] > when, get_all_events())
+    listed = takewhile(lambda event: event["start"] > when, get_listed_events())
+    yield from add_all_event_details(listed, workers)
 
 
 @aws_lambda
 @preprocess(TIMEZONE, timedelta(days=7))
 def run(since):
-    return {"events": list(get_events_since(since))}
+    return {"events": get_events_since(since)}
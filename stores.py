@@ -0,0 +1,182 @@
+"""Simple key-value stores for persisting scraper state between runs. Values
+are bytes; keys are strings that may contain slashes.
+
+A store is either a directory on the local filesystem (by default under /tmp,
+which survives warm Lambda invocations) or a prefix in an S3 bucket.
+"""
+import json
+import os
+import tempfile
+import time
+from urllib.parse import quote_plus, unquote_plus
+
+
+class FileStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, quote_plus(key))
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as infile:
+                return infile.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        # Write to a temporary file first so that concurrent readers never see
+        # a partially written value.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        "Generates (key, size in bytes, modification timestamp) tuples."
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith(".tmp"):
+                stat = entry.stat()
+                yield unquote_plus(entry.name), stat.st_size, stat.st_mtime
+
+
+class S3Store(object):
+    def __init__(self, bucket, prefix="", client=None):
+        if not client:
+            import boto3
+            client = boto3.client("s3")
+
+        self.S3 = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        """Returns the value stored at `key`, or None if there is none.
+
+        A missing key only reads as 404 NoSuchKey when the caller may list the
+        bucket; otherwise S3 answers 403 AccessDenied. That error is raised
+        rather than treated as a miss, since it may also mean that the store
+        is misconfigured, and state written back after a false miss would
+        clobber the real value.
+
+        """
+        try:
+            response = self.S3.get_object(Bucket=self.bucket,
+                                          Key=self.prefix + key)
+        except self.S3.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+        return response["Body"].read()
+
+    def put(self, key, data):
+        self.S3.put_object(Bucket=self.bucket, Key=self.prefix + key,
+                           Body=data)
+
+    def delete(self, key):
+        self.S3.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def entries(self):
+        "Generates (key, size in bytes, modification timestamp) tuples."
+        paginator = self.S3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                yield (obj["Key"][len(self.prefix):], obj["Size"],
+                       obj["LastModified"].timestamp())
+
+
+def get_json(store, key, default=None):
+    data = store.get(key)
+    return default if data is None else json.loads(data.decode("utf-8"))
+
+
+def put_json(store, key, value, **kwargs):
+    store.put(key, json.dumps(value, **kwargs).encode("utf-8"))
+
+
+def evict(store, max_bytes=None, max_age=None, max_entries=None):
+    """Removes entries from the store, oldest first, until it holds at most
+    `max_entries` entries totaling at most `max_bytes` bytes, and no entry is
+    older than `max_age` seconds.
+
+    :returns: the number of entries removed
+
+    """
+    entries = sorted(store.entries(), key=lambda entry: entry[2])
+    total = sum(size for _, size, _ in entries)
+    count = len(entries)
+    cutoff = max_age and time.time() - max_age
+    removed = 0
+
+    for key, size, mtime in entries:
+        if not ((cutoff and mtime < cutoff) or
+                (max_bytes is not None and total > max_bytes) or
+                (max_entries is not None and count > max_entries)):
+            break
+
+        store.delete(key)
+        total -= size
+        count -= 1
+        removed += 1
+
+    return removed
+
+
+class RegionState(object):
+    """Base for per-region state that is saved as JSON in the store configured
+    by `<STORE_NAME>_DIR` or `<STORE_NAME>_BUCKET` (see `store_from_env`).
+    Subclasses implement `from_json` and `to_json`.
+
+    """
+    STORE_NAME = None
+
+    def __init__(self, region, store=None):
+        """
+        :param region: a unique identifier for the region, e.g., "somervillema"
+        :param store: where the state is persisted
+        """
+        self.region = region
+        self.store = store or self.default_store()
+
+    @classmethod
+    def default_store(cls):
+        return store_from_env(cls.STORE_NAME)
+
+    @property
+    def key(self):
+        return f"{self.region}.json"
+
+    @classmethod
+    def load(cls, region, store=None):
+        "Loads the saved state for the region, or an empty state."
+        store = store or cls.default_store()
+        return cls.from_json(region, store,
+                             get_json(store, f"{region}.json", None))
+
+    def save(self):
+        put_json(self.store, self.key, self.to_json())
+
+
+def store_from_env(name, default_dir=None):
+    """Creates a store configured by environment variables. If `<name>_BUCKET`
+    is set, values are kept in that S3 bucket under `<name>_PREFIX`.
+    Otherwise, they are written to the directory `<name>_DIR`.
+
+    """
+    bucket = os.environ.get(f"{name}_BUCKET")
+    if bucket:
+        default_prefix = name.lower().replace("_", "-") + "/"
+        return S3Store(bucket, os.environ.get(f"{name}_PREFIX", default_prefix))
+
+    default_dir = default_dir or os.path.join(
+        tempfile.gettempdir(), "cornerwise", name.lower().replace("_", "-"))
+    return FileStore(os.environ.get(f"{name}_DIR", default_dir))
@@ -0,0 +1,50 @@
+"""Persisted high-water marks for incremental scraping.
+
+A watermark records the newest update time a scraper has produced for a region,
+along with the case numbers seen at exactly that time. Sources that list cases
+newest first can stop at the first case the watermark has already seen.
+
+Watermarks are kept in the store configured by WATERMARK_DIR or
+WATERMARK_BUCKET (see `stores.store_from_env`).
+"""
+from stores import RegionState
+
+
+class Watermark(RegionState):
+    STORE_NAME = "WATERMARK"
+
+    def __init__(self, region, store=None, timestamp=None, seen=()):
+        """
+        :param timestamp: POSIX timestamp of the newest update seen
+        :param seen: case numbers updated at `timestamp`
+        """
+        super().__init__(region, store)
+        self.timestamp = timestamp
+        self.seen = set(seen)
+
+    @classmethod
+    def from_json(cls, region, store, data):
+        data = data or {}
+        return cls(region, store, data.get("timestamp"), data.get("seen", []))
+
+    def to_json(self):
+        return {"timestamp": self.timestamp, "seen": sorted(self.seen)}
+
+    def has_seen(self, case, date_column="updated_date"):
+        "Returns True if the case was already produced by an earlier run."
+        if self.timestamp is None:
+            return False
+
+        ts = case[date_column].timestamp()
+        return ts < self.timestamp or \
+            (ts == self.timestamp and case["case_number"] in self.seen)
+
+    def advance(self, cases, date_column="updated_date"):
+        "Moves the watermark forward to include the given cases."
+        for case in cases:
+            ts = case[date_column].timestamp()
+            if self.timestamp is None or ts > self.timestamp:
+                self.timestamp = ts
+                self.seen = {case["case_number"]}
+            elif ts == self.timestamp:
+                self.seen.add(case["case_number"])